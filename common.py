@@ -1,8 +1,11 @@
 
 from __future__ import absolute_import
 
+import hashlib
+import json
 import logging
 import os
+import shutil
 from glob import glob
 from time import sleep
 import re
@@ -20,15 +23,15 @@ LOG = logging.getLogger(__name__)
 def cat(fns, outfn):
     """
     cat files together
-    NOT USED NOW
     :param fns:
     :param outfn:
     :return:
     """
     LOG.debug("cat %s >%s" % (" ".join(fns), outfn))
-    with open(outfn, "w") as out:
+    with open(outfn, "wb") as out:
         for fn in fns:
-            out.write(open(fn).read())
+            with open(fn, "rb") as fh:
+                shutil.copyfileobj(fh, out)
 
     return outfn
 
@@ -276,6 +279,76 @@ def get_genome_size(genome):
     return r / 1000000.0
 
 
+def count_residues(fasta):
+    """
+    return the number of sequences and residues of a fasta file
+    :param fasta:
+    :return:
+    """
+    seqs = residues = 0
+
+    with open(fasta, "rb") as fh:
+        for line in fh:
+            if line.startswith(b">"):
+                seqs += 1
+            else:
+                residues += len(line.strip())
+
+    return seqs, residues
+
+
+def string_digest(*strings):
+    """
+    sha1 of strings
+    :param strings:
+    :return:
+    """
+    r = hashlib.sha1()
+
+    for string in strings:
+        r.update(("%s\n" % string).encode("utf-8"))
+
+    return r.hexdigest()
+
+
+def file_digest(files, cache=""):
+    """
+    sha1 of the content of files, the digest of a file with the same size
+    and mtime as recorded in the json cache is not computed again
+    :param files:
+    :param cache: json file of digests
+    :return:
+    """
+    known = {}
+    if cache and os.path.exists(cache):
+        known = json.load(open(cache))
+
+    r = hashlib.sha1()
+
+    for file in sorted(check_paths(files)):
+        stat = os.stat(file)
+        stamp = "%s %s" % (stat.st_size, stat.st_mtime)
+
+        if file in known and known[file][0] == stamp:
+            digest = known[file][1]
+        else:
+            LOG.info("sha1 %s" % file)
+            h = hashlib.sha1()
+            with open(file, "rb") as fh:
+                for block in iter(lambda: fh.read(1 << 20), b""):
+                    h.update(block)
+            digest = h.hexdigest()
+            known[file] = [stamp, digest]
+
+        r.update(("%s %s\n" % (os.path.basename(file), digest)).encode("utf-8"))
+
+    if cache:
+        with open(cache, "w") as out:
+            json.dump(known, out, indent=2)
+
+    return r.hexdigest()
+
+
 def get_version(tool):
 
     _version = os.popen(tool["GETVER"]).read().strip()
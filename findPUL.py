@@ -3,8 +3,16 @@
 
 import os
 import sys
+import json
+import math
+import time
 import logging
+import shutil
 import argparse
+import subprocess
+
+from glob import glob
+from collections import OrderedDict
 
 LOG = logging.getLogger(__name__)
 
@@ -15,29 +23,92 @@ __all__ = []
 
 
 from dagflow import Task, ParallelTask, DAG, do_dag
-from common import check_path, mkdir
+from common import check_path, mkdir, rm, cat, read_tsv, file_digest, string_digest, count_residues
+import native
 from seqkit.split import seq_split
 QUEUE = "-q all.q,s01"
 ROOT = "/Work/user/zhangxg/pipeline/findPUL"
 SCRIPTS = os.path.join(ROOT, "scripts")
 DIAMOND_BIN = "/Work/pipeline/software/Base/diamond/v2.0.3/"
 BLAST_BIN = "/Work/pipeline/software/Base/blast+/bin/"
+HMMER_BIN = "/Work/pipeline/software/Base/hmmer/bin/"
 
 CAZY = "/Work/database/CAZy/v10/"
 CAZY_DB = os.path.join(CAZY, "CAZy.dmnd")
 CAZY_ACTIV = os.path.join(CAZY, "CAZy.activities.txt")
 CAZY_SUBFAM = os.path.join(CAZY, "CAZy.subfam.txt")
+# cazyproc.py --compile --activ CAZY_ACTIV --subfam CAZY_SUBFAM --index CAZY_INDEX
+CAZY_INDEX = os.path.join(CAZY, "CAZy.tables.idx")
 
 PHI_DB = "/Work/database/phi/v4-12/phi"
 PUL_DB = "/Work/database/dbCAN-PUL/v202010/PUL"
+# pulproc.py --compile -d PUL_DB.txt --index PUL_INDEX
+PUL_INDEX = "%s.txt.sqlite" % PUL_DB
 GDB = "/Work/user/zhangxg/pipeline/findPUL/database/SUS"
+# the Pfam and TIGRFAMs models of the SUS families in the README, hmmpress'ed
+SUS_HMM = "/Work/user/zhangxg/pipeline/findPUL/database/SUS.hmm"
 
+CAZY_OPTION = "--max-target-seqs 5 --evalue 1e-05"
+BLAST_OPTION = "-max_target_seqs 5 -evalue 1e-05"
+HMM_EVALUE = 1e-05
+CAZY_FIELDS = "qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore qlen slen stitle"
+SUFFIX = {"cazy": "CAZy", "pul": "pul", "sus": "sus"}
+TAG_SEP = "__"
+WORK_DIRS = {
+    "split": "00_data",
+    "cazy": "01_CAZy",
+    "pul": "02_PUL",
+    "sus": "03_SUS",
+    "search": "04_search",
+    "sample": "05_sample",
+}
+FILTER_OUT = {
+    "cazy": "qseqid sseqid qstart qend evalue bitscore stitle",
+    "pul": "qseqid sseqid qstart qend stitle evalue bitscore",
+    "sus": "qseqid sseqid qstart qend stitle evalue bitscore",
+}
+# thread-seconds to search a million residues, calibrated by --probe
+SEARCH_COST = {"cazy": 60.0, "pul": 90.0, "sus": 30.0}
+MIN_JOB_TIME = 600
+MAX_JOB_TIME = 4 * 3600
+PROBE_RESIDUES = 200000
+
+
+def blast_script(db, query, out, threads, sus_engine="blastp"):
+    """
+    the shell command to search the query against dbCAN-PUL or SUS, the SUS
+    search is blastp against GDB or hmmsearch against the SUS models
+    """
+    if db == "sus" and sus_engine == "hmm":
+        return """python {script}/hmm_sus.py {query} --hmm {hmm} --cpu {threads} \\
+--evalue {evalue} --hmmsearch {hmmsearch} --out {out}""".format(
+            script=SCRIPTS,
+            query=query,
+            hmm=SUS_HMM,
+            threads=threads,
+            evalue=HMM_EVALUE,
+            hmmsearch=os.path.join(HMMER_BIN, "hmmsearch"),
+            out=out)
+
+    return """blastp -query {query} -db {db} \\
+-outfmt '6 std qlen slen stitle' \\
+{option} -num_threads {threads} -out {out}""".format(
+        query=query,
+        db={"pul": PUL_DB, "sus": GDB}[db],
+        option=BLAST_OPTION,
+        threads=threads,
+        out=out)
 
-def create_cazy_task(proteins, prefix, evalue, coverage, threads, job_type,
-                     work_dir="", out_dir=""):
+
+def create_search_task(proteins, threads, job_type, work_dir="", keys=None, sus_engine="blastp"):
+    """
+    search each chunk against CAZy, dbCAN-PUL and SUS in one job, the chunk
+    is staged to local scratch once and shared by the three aligners, the
+    job fails with the first aligner that fails
+    """
 
     prefixs = [os.path.basename(i) for i in proteins]
-    id = "cazy"
+    id = "search"
 
     tasks = ParallelTask(
         id=id,
@@ -45,38 +116,108 @@ def create_cazy_task(proteins, prefix, evalue, coverage, threads, job_type,
         type=job_type,
         option="-pe smp %s %s" % (threads, QUEUE),
         script="""
+export PATH={diamond}:{blast}:$PATH
+query=${{{{TMPDIR:-.}}}}/{{prefixs}}.query.fasta
+trap 'rm -f $query' EXIT
+cp {{proteins}} $query || exit 1
+time diamond blastp --query $query --db {cazy_db} \\
+--outfmt 6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore qlen slen stitle \\
+{cazy_option} --threads {threads} --out {{prefixs}}.CAZy.m6 || exit 1
+echo {cazy_key} >{{prefixs}}.CAZy.key
+time {pul_search} || exit 1
+echo {pul_key} >{{prefixs}}.pul.key
+time {sus_search} || exit 1
+echo {sus_key} >{{prefixs}}.sus.key
+""".format(diamond=DIAMOND_BIN,
+           blast=BLAST_BIN,
+           cazy_db=CAZY_DB,
+           pul_search=blast_script("pul", "$query", "{prefixs}.pul.m6", threads),
+           sus_search=blast_script("sus", "$query", "{prefixs}.sus.m6", threads, sus_engine),
+           cazy_option=CAZY_OPTION,
+           cazy_key=keys["cazy"],
+           pul_key=keys["pul"],
+           sus_key=keys["sus"],
+           threads=threads),
+        proteins=proteins,
+        prefixs=prefixs,
+    )
+
+    return tasks, os.path.join(work_dir, "%s*" % id)
+
+
+def create_db_search_task(db, proteins, threads, job_type, work_dir="", key="", sus_engine="blastp"):
+    """
+    search each chunk against one database, one job per chunk
+    """
+
+    prefixs = [os.path.basename(i) for i in proteins]
+
+    if db == "cazy":
+        script = """
 export PATH={diamond}:$PATH
 time diamond blastp --query {{proteins}} --db {db} \\
---outfmt 6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore qlen slen stitle \\
---max-target-seqs 5 --evalue 1e-05 --threads {threads} --out {{prefixs}}.CAZy.m6
+--outfmt 6 {fields} \\
+{option} --threads {threads} --out {{prefixs}}.CAZy.m6 && \\
+echo {key} >{{prefixs}}.CAZy.key
 """.format(diamond=DIAMOND_BIN,
            db=CAZY_DB,
-           evalue=evalue,
-           coverage=coverage,
-           threads=threads),
+           fields=CAZY_FIELDS,
+           option=CAZY_OPTION,
+           key=key,
+           threads=threads)
+    else:
+        script = """
+export PATH={blast}:$PATH
+time {search} && \\
+echo {key} >{{prefixs}}.{suffix}.key
+""".format(blast=BLAST_BIN,
+           search=blast_script(db, "{proteins}", "{prefixs}.%s.m6" % SUFFIX[db], threads, sus_engine),
+           suffix=SUFFIX[db],
+           key=key)
+
+    tasks = ParallelTask(
+        id=db,
+        work_dir="%s/{id}" % work_dir,
+        type=job_type,
+        option="-pe smp %s %s" % (threads, QUEUE),
+        script=script,
         proteins=proteins,
         prefixs=prefixs,
     )
 
+    return tasks, os.path.join(work_dir, "%s*" % db)
+
+
+def create_cazy_task(proteins, prefix, evalue, coverage, threads, job_type,
+                     work_dir="", out_dir="", search="", keep_m6=True, key="", id="merge_CAZy"):
+
+    tasks = []
+    if not search:
+        tasks, search = create_db_search_task("cazy", proteins, threads, job_type, work_dir, key)
+
     join_task = Task(
-        id="merge_CAZy",
+        id=id,
         work_dir=work_dir,
         type=job_type,
-        option="-pe smp 1 %s" % QUEUE,
+        option="-pe smp %s %s" % (threads, QUEUE),
         script="""
-cat {id}*/*.CAZy.m6 > {prefix}.CAZy.m6
-time {script}/blast_filter.py {prefix}.CAZy.m6 \\
+{merge}
+time {script}/blast_filter.py {search}/*.CAZy.m6 --jobs {threads} \\
   --outfmt std qlen slen stitle --out qseqid sseqid qstart qend evalue bitscore stitle \\
   --min_qcov {coverage} --min_scov 0 --evalue {evalue} --best >{prefix}.CAZy.out
 {script}/cazyproc.py {prefix}.CAZy.out --activ {activ} \\
-  --subfam {subfam} -o {prefix}.cazy_classify.tsv >{prefix}.cazy.tsv
+  --subfam {subfam} --index {index} -o {prefix}.cazy_classify.tsv >{prefix}.cazy.tsv
 {script}/plot_cazy.py {prefix}.cazy_classify.tsv -p {prefix}
-cp {prefix}.CAZy.m6 {prefix}.CAZy.out {prefix}.cazy.tsv {out_dir}
+cp {m6}{prefix}.CAZy.out {prefix}.cazy.tsv {out_dir}
 cp {prefix}.cazy_classify.tsv {prefix}.cazy.png {prefix}.cazy.pdf {out_dir}
-""".format(id=id,
+""".format(search=search,
+           merge="cat {0}/*.CAZy.m6 > {1}.CAZy.m6".format(search, prefix) if keep_m6 else "",
+           m6="%s.CAZy.m6 " % prefix if keep_m6 else "",
+           threads=threads,
            prefix=prefix,
            activ=CAZY_ACTIV,
            subfam=CAZY_SUBFAM,
+           index=CAZY_INDEX,
            script=SCRIPTS,
            evalue=evalue,
            coverage=coverage,
@@ -89,44 +230,31 @@ cp {prefix}.cazy_classify.tsv {prefix}.cazy.png {prefix}.cazy.pdf {out_dir}
 
 
 def create_pul_task(proteins, prefix, evalue, coverage, threads, job_type,
-                    work_dir="", out_dir=""):
+                    work_dir="", out_dir="", search="", keep_m6=True, key="", id="merge_pul"):
 
-    prefixs = [os.path.basename(i) for i in proteins]
-    id = "pul"
-    tasks = ParallelTask(
-        id=id,
-        work_dir="%s/{id}" % work_dir,
-        type=job_type,
-        option="-pe smp %s %s" % (threads, QUEUE),
-        script="""
-export PATH={blast}:$PATH
-time blastp -query {{proteins}} -db {db} \\
--outfmt '6 std qlen slen stitle' \\
--max_target_seqs 5 -evalue 1e-05 -num_threads {threads} -out {{prefixs}}.pul.m6 \
-""".format(blast=BLAST_BIN,
-           db=PUL_DB,
-           evalue=evalue,
-           coverage=coverage,
-           threads=threads),
-        proteins=proteins,
-        prefixs=prefixs,
-    )
+    tasks = []
+    if not search:
+        tasks, search = create_db_search_task("pul", proteins, threads, job_type, work_dir, key)
 
     join_task = Task(
-        id="merge_pul",
+        id=id,
         work_dir=work_dir,
         type=job_type,
-        option="-pe smp 1 %s" % QUEUE,
+        option="-pe smp %s %s" % (threads, QUEUE),
         script="""
-cat {id}*/*.pul.m6 > {prefix}.pul.m6
-time {script}/blast_filter.py {prefix}.pul.m6 \\
+{merge}
+time {script}/blast_filter.py {search}/*.pul.m6 --jobs {threads} \\
   --outfmt std qlen slen stitle --out qseqid sseqid qstart qend stitle evalue bitscore \\
   --min_qcov {coverage} --min_scov 0 --evalue {evalue} --best >{prefix}.pul.out
 {script}/pulproc.py {prefix}.pul.out \\
-  -d {db}.txt >{prefix}.pul.tsv 2>{prefix}.stat_pul.tsv
-cp {prefix}.pul.m6 {prefix}.pul.out {prefix}.pul.tsv {prefix}.stat_pul.tsv {out_dir}
-""".format(id=id,
+  -d {db}.txt --index {index} --stat {prefix}.stat_pul.tsv >{prefix}.pul.tsv
+cp {m6}{prefix}.pul.out {prefix}.pul.tsv {prefix}.stat_pul.tsv {out_dir}
+""".format(search=search,
+           merge="cat {0}/*.pul.m6 > {1}.pul.m6".format(search, prefix) if keep_m6 else "",
+           m6="%s.pul.m6 " % prefix if keep_m6 else "",
+           threads=threads,
            db=PUL_DB,
+           index=PUL_INDEX,
            prefix=prefix,
            script=SCRIPTS,
            evalue=evalue,
@@ -136,48 +264,33 @@ cp {prefix}.pul.m6 {prefix}.pul.out {prefix}.pul.tsv {prefix}.stat_pul.tsv {out_
 
     join_task.set_upstream(*tasks)
 
-    return tasks, join_task, os.path.join(work_dir, "%s.stat_pul.tsv" % prefix)
+    return tasks, join_task, os.path.join(work_dir, "%s.pul.tsv" % prefix)
 
 
 def create_sus_task(proteins, prefix, evalue, coverage, threads, job_type,
-                    work_dir="", out_dir=""):
+                    work_dir="", out_dir="", search="", keep_m6=True, key="", id="merge_sus",
+                    sus_engine="blastp"):
 
-    prefixs = [os.path.basename(i) for i in proteins]
-    id = "sus"
-
-    tasks = ParallelTask(
-        id=id,
-        work_dir="%s/{id}" % work_dir,
-        type=job_type,
-        option="-pe smp %s %s" % (threads, QUEUE),
-        script="""
-export PATH={blast}:$PATH
-time blastp -query {{proteins}} -db {db} \\
--outfmt '6 std qlen slen stitle' \\
--max_target_seqs 5 -evalue 1e-05 -num_threads {threads} -out {{prefixs}}.sus.m6 \
-""".format(blast=BLAST_BIN,
-           db=GDB,
-           evalue=evalue,
-           coverage=coverage,
-           threads=threads),
-        proteins=proteins,
-        prefixs=prefixs,
-    )
+    tasks = []
+    if not search:
+        tasks, search = create_db_search_task("sus", proteins, threads, job_type, work_dir, key, sus_engine)
 
     join_task = Task(
-        id="merge_sus",
+        id=id,
         work_dir=work_dir,
         type=job_type,
-        option="-pe smp 1 %s" % QUEUE,
+        option="-pe smp %s %s" % (threads, QUEUE),
         script="""
-cat {id}*/*.sus.m6 > {prefix}.sus.m6
-time {script}/blast_filter.py {prefix}.sus.m6 \\
+{merge}
+time {script}/blast_filter.py {search}/*.sus.m6 --jobs {threads} \\
   --outfmt std qlen slen stitle --out qseqid sseqid qstart qend stitle evalue bitscore \\
   --min_qcov {coverage} --min_scov 0 --evalue {evalue} --best >{prefix}.sus.out
 {script}/susproc.py {prefix}.sus.out >{prefix}.stat_sus.tsv
-cp {prefix}.sus.m6 {prefix}.sus.out {prefix}.stat_sus.tsv {out_dir}
-""".format(id=id,
-           db=PUL_DB,
+cp {m6}{prefix}.sus.out {prefix}.stat_sus.tsv {out_dir}
+""".format(search=search,
+           merge="cat {0}/*.sus.m6 > {1}.sus.m6".format(search, prefix) if keep_m6 else "",
+           m6="%s.sus.m6 " % prefix if keep_m6 else "",
+           threads=threads,
            prefix=prefix,
            script=SCRIPTS,
            evalue=evalue,
@@ -187,48 +300,492 @@ cp {prefix}.sus.m6 {prefix}.sus.out {prefix}.stat_sus.tsv {out_dir}
 
     join_task.set_upstream(*tasks)
 
-    return tasks, join_task, os.path.join(work_dir, "%s.stat_pul.tsv" % prefix)
+    return tasks, join_task, os.path.join(work_dir, "%s.sus.out" % prefix)
+
 
+def gff_args(gff="", gap_bp=-1, strand=False):
+    """
+    the options of find_pul.py to call the PULs from the gene coordinates
+    """
+    if not gff:
+        return []
 
-def create_merge_task(cazy, pul, sus, job_type, work_dir="", out_dir=""):
+    return ["--gff", gff, "--gap_bp", str(gap_bp)] + (["--strand"] if strand else [])
+
+
+def create_merge_task(prefix, cazy, pul, sus, job_type, work_dir="", out_dir="", id="merge_puldb", threads=1,
+                      gff="", gap_bp=-1, strand=False):
 
     task = Task(
-        id="merge_puldb",
+        id=id,
         work_dir=work_dir,
         type=job_type,
-        option="-pe smp 1 %s" % QUEUE,
+        option="-pe smp %s %s" % (threads, QUEUE),
         script="""
 python {script}/merge_puldb.py {pul} \\
   --cazy {cazy} --sus {sus} >{prefix}.merge_puldb.tsv
-python {script}/find_pul.py {prefix}.merge_puldb.tsv --gap 4 --minegene 2 --gaps 3 >{prefix}.predict.pul.xls
+python {script}/find_pul.py {prefix}.merge_puldb.tsv --gaplen 4 --minegene 2 --gaps 3 \\
+  --jobs {threads}{gff} >{prefix}.predict.pul.xls
 cp {prefix}.merge_puldb.tsv {prefix}.predict.pul.xls {out_dir}
 """.format(script=SCRIPTS,
+           threads=threads,
+           gff="".join(" %s" % i for i in gff_args(gff, gap_bp, strand)),
+           cazy=cazy,
+           pul=pul,
+           sus=sus,
            prefix=prefix,
            out_dir=out_dir)
     )
 
-    return tasks 
+    return task
+
+
+def create_demux_task(samples, searchs, job_type, work_dir):
+    """
+    split the search results of the packed samples back to the samples
+    """
+
+    task = Task(
+        id="demux",
+        work_dir=work_dir,
+        type=job_type,
+        option="-pe smp 1 %s" % QUEUE,
+        script="".join("""
+{script}/demux_m6.py {search}/*.{suffix}.m6 --samples {samples} \\
+  --suffix {suffix} --out_dir {work_dir}""".format(script=SCRIPTS,
+                                                  search=searchs[db],
+                                                  suffix=SUFFIX[db],
+                                                  samples=samples,
+                                                  work_dir=work_dir) for db in ["cazy", "pul", "sus"]) + "\n"
+    )
+
+    return task
+
+
+def search_command(db, query, out, threads, sus_engine="blastp"):
+    """
+    the command to search the query against db
+    """
+    if db == "sus" and sus_engine == "hmm":
+        return [sys.executable, os.path.join(SCRIPTS, "hmm_sus.py"), query, "--hmm", SUS_HMM,
+                "--cpu", str(threads), "--evalue", str(HMM_EVALUE),
+                "--hmmsearch", os.path.join(HMMER_BIN, "hmmsearch"), "--out", out]
+    if db == "cazy":
+        return [os.path.join(DIAMOND_BIN, "diamond"), "blastp", "--query", query,
+                "--db", CAZY_DB, "--outfmt", "6"] + CAZY_FIELDS.split() + CAZY_OPTION.split() + [
+                "--threads", str(threads), "--out", out]
+
+    return [os.path.join(BLAST_BIN, "blastp"), "-query", query,
+            "-db", {"pul": PUL_DB, "sus": GDB}[db], "-outfmt", "6 std qlen slen stitle"] + \
+        BLAST_OPTION.split() + ["-num_threads", str(threads), "-out", out]
+
+
+def head_fasta(fasta, residues, out):
+    """
+    write the first sequences of fasta holding about residues to out
+    """
+    n = 0
+
+    with open(fasta) as fh, open(out, "w") as fo:
+        for line in fh:
+            if line.startswith(">") and n >= residues:
+                break
+            if not line.startswith(">"):
+                n += len(line.strip())
+            fo.write(line)
+
+    return n
+
+
+def probe_cost(protein, threads, work_dir, key, sus_engine="blastp"):
+    """
+    time the searches of the first residues of the protein, return the
+    thread-seconds to search a million residues against each database
+    """
+    record = os.path.join(work_dir, "probe.json")
+
+    if os.path.exists(record):
+        r = json.load(open(record))
+        if r["key"] == key:
+            LOG.info("reuse the probe of %s" % protein)
+            return r["cost"]
+
+    query = os.path.join(work_dir, "probe.fasta")
+    residues = head_fasta(protein, PROBE_RESIDUES, query)
+    if not residues:
+        return SEARCH_COST
+
+    cost = {}
+
+    for db in ["cazy", "pul", "sus"]:
+        command = search_command(db, query, os.devnull, threads, sus_engine)
+        LOG.info("probe %s" % " ".join(command))
+        start = time.time()
+        subprocess.check_call(command)
+        cost[db] = (time.time() - start) * threads * 1000000.0 / residues
+        LOG.info("%s costs %.1f thread-seconds per million residues" % (db, cost[db]))
+
+    with open(record, "w") as fh:
+        json.dump({"key": key, "cost": cost}, fh, indent=2)
+
+    return cost
+
+
+def chunk_residues(residues, seqs, threads, concurrent, cost, search_mode="separate"):
+    """
+    residues per chunk, the chunks fill the concurrent jobs in balanced waves
+    with every search job between MIN_JOB_TIME and MAX_JOB_TIME when possible
+    """
+    if search_mode == "combined":
+        jobs = [sum(cost.values())]
+    else:
+        jobs = list(cost.values())
+
+    # wall time of the longest search job if the input were one chunk
+    longest = residues / 1000000.0 * max(jobs) / threads
+    fill = max(1, int(math.ceil(concurrent * 1.0 / len(jobs))))
+    waves = int(math.ceil(longest / (fill * MAX_JOB_TIME)))
+
+    if waves > 1:
+        n = fill * waves
+    else:
+        n = min(fill, max(1, int(longest / MIN_JOB_TIME)))
+    n = max(1, min(n, seqs))
+
+    LOG.info("split %s residues into %s chunks, about %.0f seconds per job" % (
+        residues, n, longest / n))
+    return max(1, int(math.ceil(residues * 1.0 / n)))
+
+
+def split_protein(protein, num, work_dir, digest=""):
+    """
+    split the protein by length, the chunks of a previous run with the same
+    input content and chunk size are reused
+    """
+    key = string_digest(file_digest([protein], digest), "length", num)
+    manifest = os.path.join(work_dir, "split.json")
+
+    if os.path.exists(manifest):
+        r = json.load(open(manifest))
+        if r["key"] == key and all(os.path.exists(i) for i in r["proteins"]):
+            LOG.info("reuse the split of %s" % protein)
+            return key, r["proteins"]
+
+    proteins = seq_split([protein], mode="length", num=num, output_dir=work_dir)
+
+    with open(manifest, "w") as fh:
+        json.dump({"key": key, "proteins": proteins}, fh, indent=2)
+
+    return key, proteins
+
+
+def search_done(work_dir, id, proteins, suffix, key):
+    """
+    check every chunk has a search result stamped with key
+    """
+
+    for protein in proteins:
+        name = "%s.%s" % (os.path.basename(protein), suffix)
+        stamps = glob(os.path.join(work_dir, "%s*" % id, "%s.key" % name))
+
+        if len(stamps) != 1 or open(stamps[0]).read().strip() != key:
+            return False
+        if not os.path.exists(os.path.join(os.path.dirname(stamps[0]), "%s.m6" % name)):
+            return False
+
+    return True
+
+
+def clean_search(work_dir, id, suffixs):
+    """
+    remove the search results of a previous run, so the join tasks only see
+    the chunks of this run
+    """
+    for suffix in suffixs:
+        rm(glob(os.path.join(work_dir, "%s*" % id, "*.%s.m6" % suffix)))
+        rm(glob(os.path.join(work_dir, "%s*" % id, "*.%s.key" % suffix)))
+
+
+def write_key(file, key):
+
+    with open(file, "w") as fh:
+        fh.write("%s\n" % key)
+
+    return file
+
+
+def copy_files(files, out_dir):
+
+    for file in files:
+        shutil.copy(file, out_dir)
+
+    return 0
+
+
+def create_native_filter(task, db, m6s, prefix, evalue, coverage, threads, keep_m6=True):
+    """
+    merge and filter the search results of db in task, return the outputs
+    """
+    r = []
+
+    if keep_m6:
+        r.append(os.path.join(task.work_dir, "%s.%s.m6" % (prefix, SUFFIX[db])))
+        task.add_call(cat, m6s, r[-1])
+
+    task.add_script(os.path.join(SCRIPTS, "blast_filter.py"), m6s + [
+        "--jobs", str(threads), "--outfmt", "std", "qlen", "slen", "stitle",
+        "--out"] + FILTER_OUT[db].split() + [
+        "--min_qcov", str(coverage), "--min_scov", "0", "--evalue", str(evalue), "--best"],
+        stdout="%s.%s.out" % (prefix, SUFFIX[db]))
+    r.append(os.path.join(task.work_dir, "%s.%s.out" % (prefix, SUFFIX[db])))
+
+    return r
+
+
+def create_native_search(dag, proteins, threads, work_dict, searchs, keys, search_mode="separate",
+                         sus_engine="blastp"):
+    """
+    add the search tasks of the chunks to the native dag, return the tasks
+    and the search results of each database
+    """
+    tasks = dict((db, []) for db in SUFFIX)
+    m6s = dict((db, []) for db in SUFFIX)
+
+    for db in SUFFIX:
+        if searchs[db]:
+            m6s[db] = sorted(glob(os.path.join(searchs[db], "*.%s.m6" % SUFFIX[db])))
+
+    for n, protein in enumerate(proteins, 1):
+        name = os.path.basename(protein)
+        task = None
+
+        for db in ["cazy", "pul", "sus"]:
+            if searchs[db]:
+                continue
+            id = "search" if search_mode == "combined" else db
+            if task is None or search_mode != "combined":
+                task = native.Task("%s_%03d" % (id, n), os.path.join(work_dict[id], "%s_%03d" % (id, n)), threads)
+                dag.add_task(task)
+            m6 = "%s.%s.m6" % (name, SUFFIX[db])
+            task.add_command(search_command(db, protein, m6, threads, sus_engine))
+            task.add_call(write_key, os.path.join(task.work_dir, "%s.%s.key" % (name, SUFFIX[db])), keys[db])
+            m6s[db].append(os.path.join(task.work_dir, m6))
+            tasks[db].append(task)
+
+    return tasks, m6s
+
+
+def create_native_sample(dag, prefix, evalue, coverage, threads, work_dir, work_dict,
+                         out_dir, m6s, upstream, keep_m6=True, gff="", gap_bp=-1, strand=False):
+    """
+    add the filter, annotation and merge tasks of a sample to the native dag
+    """
+    cazy = native.Task("%s_merge_CAZy" % prefix, work_dict["cazy"], threads).set_upstream(*upstream["cazy"])
+    outs = create_native_filter(cazy, "cazy", m6s["cazy"], prefix, evalue, coverage, threads, keep_m6)
+    cazy.add_script(os.path.join(SCRIPTS, "cazyproc.py"), [
+        "%s.CAZy.out" % prefix, "--activ", CAZY_ACTIV, "--subfam", CAZY_SUBFAM, "--index", CAZY_INDEX,
+        "-o", "%s.cazy_classify.tsv" % prefix], stdout="%s.cazy.tsv" % prefix)
+    cazy.add_script(os.path.join(SCRIPTS, "plot_cazy.py"), ["%s.cazy_classify.tsv" % prefix, "-p", prefix])
+    cazy.add_call(copy_files, outs + [os.path.join(work_dict["cazy"], "%s.%s" % (prefix, i)) for i in [
+        "cazy.tsv", "cazy_classify.tsv", "cazy.png", "cazy.pdf"]], out_dir)
+
+    pul = native.Task("%s_merge_pul" % prefix, work_dict["pul"], threads).set_upstream(*upstream["pul"])
+    outs = create_native_filter(pul, "pul", m6s["pul"], prefix, evalue, coverage, threads, keep_m6)
+    pul.add_script(os.path.join(SCRIPTS, "pulproc.py"), [
+        "%s.pul.out" % prefix, "-d", "%s.txt" % PUL_DB, "--index", PUL_INDEX,
+        "--stat", "%s.stat_pul.tsv" % prefix], stdout="%s.pul.tsv" % prefix)
+    pul.add_call(copy_files, outs + [os.path.join(work_dict["pul"], "%s.%s" % (prefix, i)) for i in [
+        "pul.tsv", "stat_pul.tsv"]], out_dir)
+
+    sus = native.Task("%s_merge_sus" % prefix, work_dict["sus"], threads).set_upstream(*upstream["sus"])
+    outs = create_native_filter(sus, "sus", m6s["sus"], prefix, evalue, coverage, threads, keep_m6)
+    sus.add_script(os.path.join(SCRIPTS, "susproc.py"), ["%s.sus.out" % prefix],
+                   stdout="%s.stat_sus.tsv" % prefix)
+    sus.add_call(copy_files, outs + [os.path.join(work_dict["sus"], "%s.stat_sus.tsv" % prefix)], out_dir)
+
+    merge = native.Task("%s_merge_puldb" % prefix, work_dir, threads).set_upstream(cazy, pul, sus)
+    merge.add_script(os.path.join(SCRIPTS, "merge_puldb.py"), [
+        os.path.join(work_dict["pul"], "%s.pul.tsv" % prefix),
+        "--cazy", os.path.join(work_dict["cazy"], "%s.cazy.tsv" % prefix),
+        "--sus", os.path.join(work_dict["sus"], "%s.sus.out" % prefix)],
+        stdout="%s.merge_puldb.tsv" % prefix)
+    merge.add_script(os.path.join(SCRIPTS, "find_pul.py"), [
+        "%s.merge_puldb.tsv" % prefix, "--gaplen", "4", "--minegene", "2", "--gaps", "3",
+        "--jobs", str(threads)] + gff_args(gff, gap_bp, strand),
+        stdout="%s.predict.pul.xls" % prefix)
+    merge.add_call(copy_files, [os.path.join(work_dir, "%s.%s" % (prefix, i)) for i in [
+        "merge_puldb.tsv", "predict.pul.xls"]], out_dir)
+
+    dag.add_task(cazy, pul, sus, merge)
+
+    return merge
+
+
+def read_samples(file):
+    """
+    read a fofn of proteins or a sample sheet (sample, protein), the sample
+    of a fofn line is the name of the file without the extension. the
+    proteins are packed as text, gzip files are not supported
+    """
+    r = OrderedDict()
+
+    for line in read_tsv(file):
+        if len(line) >= 2:
+            sample, protein = line[0].strip(), line[1].strip()
+        else:
+            protein = line[0].strip()
+            sample = os.path.basename(protein).split(".")[0]
+        if sample in r:
+            raise Exception("Sample %r repeats in %s" % (sample, file))
+        if protein.endswith(".gz"):
+            raise Exception("Protein %s of sample %r is gzipped, --batch needs plain fasta" % (protein, sample))
+        r[sample] = check_path(protein)
+
+    return r
+
+
+def pack_samples(samples, work_dir, digest=""):
+    """
+    pack the proteins of the samples in one fasta, the ids are tagged with
+    the sample as S0001__id
+    """
+    protein = os.path.join(work_dir, "batch.fasta")
+    sheet = os.path.join(work_dir, "batch.samples.tsv")
+    manifest = os.path.join(work_dir, "batch.json")
+    tags = OrderedDict(("S%04d" % n, sample) for n, sample in enumerate(samples, 1))
+    key = string_digest("pack 2", *["%s %s %s" % (tag, sample, file_digest([samples[sample]], digest))
+                                    for tag, sample in tags.items()])
+
+    if os.path.exists(manifest) and os.path.exists(protein) and os.path.exists(sheet):
+        if json.load(open(manifest))["key"] == key:
+            LOG.info("reuse the packed proteins of %s samples" % len(samples))
+            return protein, sheet
+
+    with open(protein, "w") as out:
+        for tag, sample in tags.items():
+            line = "\n"
+            for line in open(samples[sample]):
+                if line.startswith(">"):
+                    line = ">%s%s%s" % (tag, TAG_SEP, line[1:])
+                out.write(line)
+            # a fasta without a newline at the end
+            if not line.endswith("\n"):
+                out.write("\n")
+
+    with open(sheet, "w") as out:
+        out.write("#tag\tsample\tprotein\n")
+        for tag, sample in tags.items():
+            out.write("%s\t%s\t%s\n" % (tag, sample, samples[sample]))
+
+    with open(manifest, "w") as fh:
+        json.dump({"key": key}, fh, indent=2)
+
+    return protein, sheet
+
+
+def create_work_dict(work_dir, names=("split", "cazy", "pul", "sus", "search")):
+
+    return dict((k, mkdir(os.path.join(work_dir, WORK_DIRS[k]))) for k in names)
+
+
+def prepare_search(protein, threads, job_type, concurrent, work_dict, digest,
+                   search_mode="separate", chunk=0, probe=False, sus_engine="blastp"):
+    """
+    split the protein and check the search results of a previous run, return
+    the chunks, the search keys and the reusable search results
+    """
+
+    # the searches are keyed on the input, the databases and the options
+    dbs = {
+        "cazy": string_digest(file_digest([CAZY_DB], digest), "diamond", CAZY_OPTION),
+        "pul": string_digest(file_digest(glob("%s.p*" % PUL_DB), digest), "blastp", BLAST_OPTION),
+        "sus": string_digest(file_digest(glob("%s.p*" % GDB), digest), "blastp", BLAST_OPTION),
+    }
+    if sus_engine == "hmm":
+        dbs["sus"] = string_digest(file_digest(glob("%s*" % SUS_HMM), digest), "hmmsearch", HMM_EVALUE)
+
+    if not chunk:
+        cost = SEARCH_COST
+        if probe:
+            cost = probe_cost(protein, threads, work_dict["split"],
+                              string_digest(threads, *[dbs[k] for k in sorted(dbs)]), sus_engine)
+        slots = concurrent
+        if job_type == "native":
+            slots = min(concurrent, max(1, (os.cpu_count() or 1) // threads))
+        seqs, residues = count_residues(protein)
+        chunk = chunk_residues(residues, seqs, threads, slots, cost, search_mode)
+
+    split_key, proteins = split_protein(protein, chunk, work_dict["split"], digest)
+    keys = dict((k, string_digest(split_key, v)) for k, v in dbs.items())
+
+    searchs = dict((k, "") for k in keys)
+    if search_mode == "combined":
+        if all(search_done(work_dict["search"], "search", proteins, SUFFIX[k], keys[k]) for k in keys):
+            LOG.info("reuse the search results in %s" % work_dict["search"])
+            searchs = dict((k, os.path.join(work_dict["search"], "search*")) for k in keys)
+        else:
+            clean_search(work_dict["search"], "search", SUFFIX.values())
+    else:
+        for k in keys:
+            if search_done(work_dict[k], k, proteins, SUFFIX[k], keys[k]):
+                LOG.info("reuse the search results in %s" % work_dict[k])
+                searchs[k] = os.path.join(work_dict[k], "%s*" % k)
+            else:
+                clean_search(work_dict[k], k, [SUFFIX[k]])
+
+    return proteins, keys, searchs
 
 
 def run_findpul(protein, prefix, evalue, coverage, threads,
-                 job_type, concurrent, refresh, work_dir="", out_dir=""):
+                 job_type, concurrent, refresh, work_dir="", out_dir="",
+                 search_mode="separate", keep_m6=True, chunk=0, probe=False, gff="",
+                 sus_engine="blastp", gap_bp=-1, strand=False):
 
     work_dir = mkdir(work_dir)
     out_dir = mkdir(out_dir)
     protein = check_path(protein)
+    if gff:
+        gff = check_path(gff)
+    work_dict = create_work_dict(work_dir)
 
-    work_dict = {
-        "split": "00_data",
-        "cazy": "01_CAZy",
-        "pul": "02_PUL",
-        "sus": "03_SUS",
-    }
-    for k, v in work_dict.items():
-        work_dict[k] = mkdir(os.path.join(work_dir, v))
+    proteins, keys, searchs = prepare_search(
+        protein, threads, job_type, concurrent, work_dict,
+        os.path.join(work_dir, "digest.json"), search_mode, chunk, probe, sus_engine)
 
-    proteins = seq_split([protein], mode="length", num=5000000, output_dir=work_dict["split"])
+    if job_type == "native":
+        dag = native.DAG("run_findpul")
+        upstream, m6s = create_native_search(dag, proteins, threads, work_dict, searchs, keys,
+                                             search_mode, sus_engine)
+        create_native_sample(
+            dag=dag,
+            prefix=prefix,
+            evalue=evalue,
+            coverage=coverage,
+            threads=threads,
+            work_dir=work_dir,
+            work_dict=work_dict,
+            out_dir=out_dir,
+            m6s=m6s,
+            upstream=upstream,
+            keep_m6=keep_m6,
+            gff=gff,
+            gap_bp=gap_bp,
+            strand=strand)
+        return native.do_dag(dag, concurrent_tasks=concurrent)
 
     dag = DAG("run_findpul")
+    search_tasks = []
+    if search_mode == "combined" and not searchs["cazy"]:
+        search_tasks, search = create_search_task(
+            proteins=proteins,
+            threads=threads,
+            job_type=job_type,
+            work_dir=work_dict["search"],
+            keys=keys,
+            sus_engine=sus_engine)
+        dag.add_task(*search_tasks)
+        searchs = dict((k, search) for k in keys)
+
     cazy_tasks, cazy_join, cazy_stat = create_cazy_task(
         proteins=proteins,
         prefix=prefix,
@@ -237,8 +794,12 @@ def run_findpul(protein, prefix, evalue, coverage, threads,
         threads=threads,
         job_type=job_type,
         work_dir=work_dict["cazy"],
-        out_dir=out_dir)
+        out_dir=out_dir,
+        search=searchs["cazy"],
+        keep_m6=keep_m6,
+        key=keys["cazy"])
     dag.add_task(*cazy_tasks)
+    cazy_join.set_upstream(*search_tasks)
     dag.add_task(cazy_join)
 
     pul_tasks, pul_join, pul_stat = create_pul_task(
@@ -249,9 +810,13 @@ def run_findpul(protein, prefix, evalue, coverage, threads,
         threads=threads,
         job_type=job_type,
         work_dir=work_dict["pul"],
-        out_dir=out_dir
+        out_dir=out_dir,
+        search=searchs["pul"],
+        keep_m6=keep_m6,
+        key=keys["pul"]
     )
     dag.add_task(*pul_tasks)
+    pul_join.set_upstream(*search_tasks)
     dag.add_task(pul_join)
 
     sus_tasks, sus_join, sus_stat = create_sus_task(
@@ -262,18 +827,28 @@ def run_findpul(protein, prefix, evalue, coverage, threads,
         threads=threads,
         job_type=job_type,
         work_dir=work_dict["sus"],
-        out_dir=out_dir
+        out_dir=out_dir,
+        search=searchs["sus"],
+        keep_m6=keep_m6,
+        key=keys["sus"],
+        sus_engine=sus_engine
     )
     dag.add_task(*sus_tasks)
+    sus_join.set_upstream(*search_tasks)
     dag.add_task(sus_join)
 
     merge_task = create_merge_task(
+        prefix=prefix,
         cazy=cazy_stat,
         pul=pul_stat,
         sus=sus_stat,
         job_type=job_type,
         work_dir=work_dir,
-        out_dir=out_dir
+        out_dir=out_dir,
+        threads=threads,
+        gff=gff,
+        gap_bp=gap_bp,
+        strand=strand
     )
     merge_task.set_upstream(cazy_join)
     merge_task.set_upstream(pul_join)
@@ -285,10 +860,126 @@ def run_findpul(protein, prefix, evalue, coverage, threads,
     return 0
 
 
+def run_batch(samples, evalue, coverage, threads, job_type, concurrent, refresh,
+              work_dir="", out_dir="", search_mode="separate", keep_m6=True, chunk=0, probe=False,
+              sus_engine="blastp"):
+    """
+    search the proteins of many samples in shared chunks and split the
+    results back to the samples
+    """
+
+    work_dir = mkdir(work_dir)
+    out_dir = mkdir(out_dir)
+    samples = read_samples(samples)
+    work_dict = create_work_dict(work_dir, list(WORK_DIRS))
+    digest = os.path.join(work_dir, "digest.json")
+
+    protein, sheet = pack_samples(samples, work_dict["split"], digest)
+    proteins, keys, searchs = prepare_search(
+        protein, threads, job_type, concurrent, work_dict, digest, search_mode, chunk, probe, sus_engine)
+
+    if job_type == "native":
+        dag = native.DAG("run_batch")
+        upstream, m6s = create_native_search(dag, proteins, threads, work_dict, searchs, keys,
+                                             search_mode, sus_engine)
+        demux = native.Task("demux", work_dict["sample"])
+        for db in ["cazy", "pul", "sus"]:
+            demux.set_upstream(*upstream[db])
+            demux.add_script(os.path.join(SCRIPTS, "demux_m6.py"), m6s[db] + [
+                "--samples", sheet, "--suffix", SUFFIX[db], "--out_dir", work_dict["sample"]])
+        dag.add_task(demux)
+
+        for sample in samples:
+            sample_dir = os.path.join(work_dict["sample"], sample)
+            create_native_sample(
+                dag=dag,
+                prefix=sample,
+                evalue=evalue,
+                coverage=coverage,
+                threads=threads,
+                work_dir=sample_dir,
+                work_dict=create_work_dict(sample_dir, ["cazy", "pul", "sus"]),
+                out_dir=mkdir(os.path.join(out_dir, sample)),
+                m6s=dict((db, [os.path.join(sample_dir, "%s.%s.m6" % (sample, SUFFIX[db]))]) for db in SUFFIX),
+                upstream=dict((db, [demux]) for db in SUFFIX),
+                keep_m6=keep_m6)
+        return native.do_dag(dag, concurrent_tasks=concurrent)
+
+    dag = DAG("run_batch")
+    search_tasks = []
+    if search_mode == "combined":
+        if not searchs["cazy"]:
+            search_tasks, search = create_search_task(
+                proteins=proteins,
+                threads=threads,
+                job_type=job_type,
+                work_dir=work_dict["search"],
+                keys=keys,
+                sus_engine=sus_engine)
+            searchs = dict((k, search) for k in keys)
+    else:
+        for db in ["cazy", "pul", "sus"]:
+            if not searchs[db]:
+                tasks, searchs[db] = create_db_search_task(
+                    db, proteins, threads, job_type, work_dict[db], keys[db], sus_engine)
+                search_tasks += tasks
+    dag.add_task(*search_tasks)
+
+    demux = create_demux_task(sheet, searchs, job_type, work_dict["sample"])
+    demux.set_upstream(*search_tasks)
+    dag.add_task(demux)
+
+    for sample in samples:
+        sample_dir = os.path.join(work_dict["sample"], sample)
+        sample_dict = create_work_dict(sample_dir, ["cazy", "pul", "sus"])
+        sample_out = mkdir(os.path.join(out_dir, sample))
+        joins, stats = [], []
+
+        for create, db, id in [(create_cazy_task, "cazy", "merge_CAZy"),
+                               (create_pul_task, "pul", "merge_pul"),
+                               (create_sus_task, "sus", "merge_sus")]:
+            tasks, join, stat = create(
+                proteins=[],
+                prefix=sample,
+                evalue=evalue,
+                coverage=coverage,
+                threads=threads,
+                job_type=job_type,
+                work_dir=sample_dict[db],
+                out_dir=sample_out,
+                search=sample_dir,
+                keep_m6=keep_m6,
+                id="%s_%s" % (sample, id))
+            join.set_upstream(demux)
+            dag.add_task(join)
+            joins.append(join)
+            stats.append(stat)
+
+        merge_task = create_merge_task(
+            prefix=sample,
+            cazy=stats[0],
+            pul=stats[1],
+            sus=stats[2],
+            job_type=job_type,
+            work_dir=sample_dir,
+            out_dir=sample_out,
+            id="%s_merge_puldb" % sample,
+            threads=threads
+        )
+        merge_task.set_upstream(*joins)
+        dag.add_task(merge_task)
+
+    do_dag(dag, concurrent_tasks=concurrent, refresh_time=refresh)
+
+    return 0
+
+
 def add_hlep_args(parser):
 
     parser.add_argument("protein", metavar='FILE', type=str,
-        help="Input protein sequence.")
+        help="Input protein sequence, or a fofn or sample sheet of proteins with --batch.")
+    parser.add_argument("--batch", action="store_true",
+        help="Search the proteins of the samples in the fofn or sample sheet (sample, protein) together, the proteins are plain fasta (not gz)")
     parser.add_argument("-p", "--prefix", metavar="STR", type=str, default="out",
         help="Input sample name.")
     parser.add_argument("-e", "--evalue", metavar="NUM", type=float, default=1e-05,
@@ -301,8 +992,24 @@ def add_hlep_args(parser):
         help="Maximum number of jobs concurrent  (default: 10)")
     parser.add_argument("--refresh", metavar="INT", type=int, default=30,
         help="Refresh time of log in seconds  (default: 30)")
-    parser.add_argument("--job_type", choices=["sge", "local"], default="local",
-        help="Jobs run on [sge, local]  (default: local)")
+    parser.add_argument("--job_type", choices=["sge", "local", "native"], default="local",
+        help="Jobs run on [sge, local, native], native runs the jobs in this process  (default: local)")
+    parser.add_argument("--search_mode", choices=["separate", "combined"], default="separate",
+        help="Search CAZy, PUL and SUS in separate jobs or in one job per chunk  (default: separate)")
+    parser.add_argument("--sus_engine", choices=["blastp", "hmm"], default="blastp",
+        help="Search SUS with blastp against the sequences or hmmsearch against the Pfam and TIGRFAMs models  (default: blastp)")
+    parser.add_argument("--skip_m6", action="store_true",
+        help="Filter the search results of each chunk directly, without writing the merged .m6 files")
+    parser.add_argument("--chunk", metavar="INT", type=int, default=0,
+        help="Residues per chunk of the searches, 0 sizes the chunks from the input, --thread and --concurrent  (default: 0)")
+    parser.add_argument("--probe", action="store_true",
+        help="Calibrate the chunk size with a short search of the first %s residues" % PROBE_RESIDUES)
+    parser.add_argument("--gff", metavar="FILE", type=str, default="",
+        help="Input the gff of the proteins (prokka, bakta), the PULs are called from the gene coordinates instead of the sample.contig.N ids")
+    parser.add_argument("--gap_bp", metavar="INT", type=int, default=-1,
+        help="Maximum distance in bp between the genes of a PUL, needs --gff, -1 is no limit (default: -1)")
+    parser.add_argument("--strand", action="store_true",
+        help="The genes of a PUL are on the same strand, needs --gff")
     parser.add_argument("--work_dir", metavar="DIR", default=".",
         help="Work directory (default: current directory)")
     parser.add_argument("--out_dir", metavar="DIR", default=".",
@@ -324,15 +1031,30 @@ name:
     run_findpul.py :Polysaccharide Utilization Loci Prediction
 attention:
     run_findpul.py protein.fasta
+    run_findpul.py samples.tsv --batch
+    run_findpul.py sample.faa --gff sample.gff
+    run_findpul.py sample.faa --gff sample.gff --gap_bp 5000 --strand
 version: %s
 contact:  %s <%s>\
         ''' % (__version__, ' '.join(__author__), __email__))
 
     args = add_hlep_args(parser).parse_args()
 
-    run_findpul(args.protein, args.prefix, args.evalue, args.coverage,
-                 args.thread, args.job_type, args.concurrent,
-                 args.refresh, args.work_dir, args.out_dir)
+    if args.batch and args.gff:
+        raise Exception("--gff is for a single sample, not --batch")
+    if (args.gap_bp >= 0 or args.strand) and not args.gff:
+        raise Exception("--gap_bp and --strand need the coordinates of the genes in --gff")
+    if args.batch:
+        run_batch(args.protein, args.evalue, args.coverage,
+                  args.thread, args.job_type, args.concurrent,
+                  args.refresh, args.work_dir, args.out_dir, args.search_mode,
+                  not args.skip_m6, args.chunk, args.probe, args.sus_engine)
+    else:
+        run_findpul(args.protein, args.prefix, args.evalue, args.coverage,
+                    args.thread, args.job_type, args.concurrent,
+                    args.refresh, args.work_dir, args.out_dir, args.search_mode,
+                    not args.skip_m6, args.chunk, args.probe, args.gff, args.sus_engine,
+                    args.gap_bp, args.strand)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,221 @@
+"""
+A local executor that runs the tasks of a DAG in this process, without
+writing shell scripts or polling their status.
+
+The python scripts of findPUL run in a pool of worker processes, other
+programs (the aligners) run through subprocess, a task is started as soon
+as its upstream tasks are done and the cores it asks for are free.
+"""
+
+import os
+import sys
+import time
+import runpy
+import logging
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from common import mkdir
+
+LOG = logging.getLogger(__name__)
+
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__version__ = "1.0.0"
+__all__ = ["Task", "DAG", "do_dag"]
+
+
+class Task(object):
+    """
+    a task of the native executor, the steps run in order in work_dir
+    """
+
+    def __init__(self, id, work_dir, threads=1):
+
+        self.id = id
+        self.work_dir = work_dir
+        self.threads = threads
+        self.steps = []
+        self.depends = []
+
+    def add_command(self, args, stdout="", stderr=""):
+        """
+        run a program through subprocess
+        """
+        self.steps.append(("command", args, stdout, stderr))
+
+        return self
+
+    def add_script(self, script, args, stdout="", stderr=""):
+        """
+        run a python script in a worker process, as if called from the shell
+        """
+        self.steps.append(("script", [script] + list(args), stdout, stderr))
+
+        return self
+
+    def add_call(self, func, *args):
+        """
+        call a python function in this process
+        """
+        self.steps.append(("call", (func, args), "", ""))
+
+        return self
+
+    def set_upstream(self, *tasks):
+
+        for task in tasks:
+            if task not in self.depends:
+                self.depends.append(task)
+
+        return self
+
+
+class DAG(object):
+
+    def __init__(self, id):
+
+        self.id = id
+        self.tasks = []
+
+    def add_task(self, *tasks):
+
+        for task in tasks:
+            if isinstance(task, (list, tuple)):
+                self.add_task(*task)
+            elif task not in self.tasks:
+                self.tasks.append(task)
+
+        return self
+
+
+def _open(file, work_dir):
+
+    if not file:
+        return None
+
+    return open(os.path.join(work_dir, file), "w")
+
+
+def run_script(args, work_dir, stdout="", stderr=""):
+    """
+    run a python script in this process with its stdout and stderr redirected
+    """
+    script = args[0]
+    out = _open(stdout, work_dir)
+    err = _open(stderr, work_dir)
+    argv, cwd = sys.argv, os.getcwd()
+    sys_stdout, sys_stderr = sys.stdout, sys.stderr
+
+    os.chdir(work_dir)
+    sys.argv = list(args)
+    if os.path.dirname(script) not in sys.path:
+        sys.path.insert(0, os.path.dirname(script))
+    sys.stdout = out or sys.stdout
+    sys.stderr = err or sys.stderr
+    # the logging.basicConfig of the script binds the redirected stderr
+    logging.root.handlers = []
+
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code not in [None, 0]:
+            raise Exception("%s exited with %s" % (script, e.code))
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdout, sys.stderr = sys_stdout, sys_stderr
+        sys.argv = argv
+        os.chdir(cwd)
+        for fh in [out, err]:
+            if fh:
+                fh.close()
+
+    return 0
+
+
+def run_task(task, pool):
+
+    work_dir = mkdir(task.work_dir)
+
+    for kind, args, stdout, stderr in task.steps:
+        start = time.time()
+
+        if kind == "command":
+            out = _open(stdout, work_dir)
+            err = _open(stderr, work_dir)
+            try:
+                subprocess.check_call(args, cwd=work_dir, stdout=out, stderr=err)
+            finally:
+                for fh in [out, err]:
+                    if fh:
+                        fh.close()
+            name = os.path.basename(args[0])
+        elif kind == "script":
+            pool.submit(run_script, args, work_dir, stdout, stderr).result()
+            name = os.path.basename(args[0])
+        else:
+            func, args = args
+            func(*args)
+            name = func.__name__
+
+        LOG.info("task %s: %s done in %.1fs" % (task.id, name, time.time() - start))
+
+    return task
+
+
+def do_dag(dag, cores=0, concurrent_tasks=0):
+    """
+    run the tasks of the dag, a task starts once its upstream tasks are done
+    and its threads fit in the free cores
+    """
+    cores = cores or os.cpu_count() or 1
+    pending = list(dag.tasks)
+    running = {}
+    done = set()
+    used = 0
+    error = None
+
+    LOG.info("run %s tasks of %s on %s cores" % (len(pending), dag.id, cores))
+    pool = ProcessPoolExecutor(max_workers=concurrent_tasks or cores)
+    jobs = ThreadPoolExecutor(max_workers=max(len(pending), 1))
+
+    try:
+        while running or (pending and not error):
+            for task in list(pending):
+                if error or (concurrent_tasks and len(running) >= concurrent_tasks):
+                    break
+                if any(i not in done for i in task.depends):
+                    continue
+                threads = min(task.threads, cores)
+                if running and used + threads > cores:
+                    continue
+                pending.remove(task)
+                used += threads
+                running[jobs.submit(run_task, task, pool)] = task
+
+            if not running:
+                raise Exception("tasks %s wait for tasks not in %s" % (
+                    ", ".join(i.id for i in pending), dag.id))
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                used -= min(task.threads, cores)
+                try:
+                    future.result()
+                except Exception as e:
+                    LOG.error("task %s failed: %s" % (task.id, e))
+                    error = error or e
+                    continue
+                done.add(task)
+    finally:
+        jobs.shutdown()
+        pool.shutdown()
+
+    if error:
+        raise Exception("%s failed, %s tasks not run" % (dag.id, len(pending)))
+
+    LOG.info("%s done" % dag.id)
+    return 0
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import random
+import argparse
+import logging
+import tempfile
+
+from blast_filter import parse_outfmt, compile_out, filter_blastp, np
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+OUTFMT = ["std", "qlen", "slen", "stitle"]
+OUT = ["qseqid", "sseqid", "qstart", "qend", "evalue", "bitscore", "stitle"]
+# subject titles ending in a multi-byte character or in unicode whitespace
+TITLES = ["CAZy family %s", "CAZy famille %s é", "β-galactosidase %s\u00a0"]
+
+
+def synthetic_hits(hits, hsps, seed=1):
+    """
+    hits of multi-domain proteins, each with many hsps on the same subject
+    """
+    random.seed(seed)
+    r = []
+
+    for n in range(hits):
+        qlen = random.randint(300, 3000)
+        slen = random.randint(300, 3000)
+        hit = []
+        for i in range(random.randint(1, hsps)):
+            qstart = random.randint(1, qlen)
+            sstart = random.randint(1, slen)
+            hit.append(["gene%s" % n, "GH%s|CBM%s" % (n % 100, n % 7), "%.3f" % random.uniform(30, 100),
+                        "120", "3", "1", str(qstart), str(min(qlen, qstart+100)),
+                        str(sstart), str(min(slen, sstart+100)), "1e-%s" % random.randint(5, 80),
+                        "%.1f" % random.uniform(30, 500), str(qlen), str(slen), TITLES[n % 3] % (n % 100)])
+        r.append(hit)
+
+    return r
+
+
+def legacy_out(hits, outfmt, out):
+    """
+    the output loop of process_blastp before compile_out
+    """
+    for hit in hits:
+        r = []
+
+        for n in out:
+            s = []
+
+            for hsp in hit:
+                mes = hsp[outfmt[n]]
+
+                if mes not in s:
+                    s.append(mes)
+                else:
+                    if n in ["pident", "mismatch", "gapopen", "qstart", "qend", "sstart", "send", "evalue", "bitscore"]:
+                        s.append(mes)
+
+            r.append(";".join(s))
+
+        yield "\t".join(r)
+
+
+def compiled_out(hits, outfmt, out):
+
+    project = compile_out(out, outfmt)
+
+    for hit in hits:
+        yield project(hit)
+
+
+def check_engines(data):
+    """
+    the numpy engine keeps the same hits as the python engine, with blocks
+    of any size, on the hits, a file of comments only and hits followed by
+    comments
+    """
+    hsps = ["%s\n" % "\t".join(hsp) for hit in data for hsp in hit]
+    cases = [
+        ("hits", hsps),
+        ("comments", ["#%s\n" % "\t".join(OUTFMT), "# comment\n"]),
+        ("trailing comments", hsps[:8] + ["# comment %s\n" % i for i in range(200)]),
+    ]
+    kwargs = dict(evalue=1e-5, pident=0, best=True, best_evalue=0, qcov=0,
+                  scov=0, outfmt=OUTFMT, out=OUT)
+
+    for name, lines in cases:
+        fd, file = tempfile.mkstemp(suffix=".m6")
+        os.close(fd)
+        try:
+            with open(file, "w", encoding="utf-8") as fh:
+                fh.writelines(lines)
+            expect = list(filter_blastp(file, "python", **kwargs))
+            for chunk in [64, 0.001]:
+                if list(filter_blastp(file, "numpy", chunk=chunk, **kwargs)) != expect:
+                    raise Exception("the numpy engine does not match the python engine on %s with chunk %s" % (
+                        name, chunk))
+        finally:
+            os.remove(file)
+
+    return 0
+
+
+def bench_blast_filter(hits, hsps, repeat=3):
+
+    outfmt = parse_outfmt(OUTFMT)
+    data = synthetic_hits(hits, hsps)
+    LOG.info("%s hits, %s hsps" % (len(data), sum(len(i) for i in data)))
+
+    legacy = list(legacy_out(data, outfmt, OUT))
+    if legacy != list(compiled_out(data, outfmt, OUT)):
+        raise Exception("compile_out does not match the legacy output")
+    if np is not None:
+        check_engines(data[:2000])
+
+    print("#method\tbest time(s)\thits/s")
+    for name, method in [("legacy", legacy_out), ("compile_out", compiled_out)]:
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            for line in method(data, outfmt, OUT):
+                pass
+            times.append(time.time() - start)
+        print("%s\t%.3f\t%.0f" % (name, min(times), len(data)/max(min(times), 1e-9)))
+
+    return 0
+
+
+def add_hlep_args(parser):
+
+    parser.add_argument("--hits", metavar="INT", type=int, default=20000,
+        help="Number of synthetic hits, default=20000")
+    parser.add_argument("--hsps", metavar="INT", type=int, default=50,
+        help="Maximum number of hsps of a hit, default=50")
+    parser.add_argument("--repeat", metavar="INT", type=int, default=3,
+        help="Number of runs of each method, default=3")
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''
+name:
+    bench_blast_filter.py: Benchmark the output projection of blast_filter.py on many-hsp hits
+
+attention:
+    bench_blast_filter.py --hits 20000 --hsps 50
+
+version: %s
+contact:  %s <%s>\
+        ''' % (__version__, ' '.join(__author__), __email__))
+
+    args = add_hlep_args(parser).parse_args()
+    bench_blast_filter(args.hits, args.hsps, args.repeat)
+
+
+if __name__ == "__main__":
+
+    main()
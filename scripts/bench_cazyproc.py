@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import time
+import random
+import hashlib
+import argparse
+import logging
+import tempfile
+
+from cazyproc import CAZY_CLASS, read_tsv, cut_type, create_resolver
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+FAMILIES = {"GH": 170, "GT": 110, "PL": 40, "CE": 20, "AA": 17, "CBM": 90}
+
+
+def synthetic_tables(subjects, seed=1):
+    """
+    the activities, subfamilies and subjects of a CAZy like database
+    """
+    random.seed(seed)
+    activ = {}
+    for name, number in FAMILIES.items():
+        for i in range(1, number+1):
+            activ["%s%s" % (name, i)] = "%s family %s" % (CAZY_CLASS[name], i)
+            if random.random() < 0.2:
+                for j in range(1, random.randint(2, 10)):
+                    activ["%s%s_%s" % (name, i, j)] = "%s subfamily %s_%s" % (CAZY_CLASS[name], i, j)
+
+    families = sorted(activ)
+    subfam = {}
+    r = []
+    for n in range(subjects):
+        seqid = "WP_%09d.1" % n
+        types = random.sample(families, random.randint(1, 3))
+        if random.random() < 0.05:
+            types.append(random.choice(["SLH", "Cohesin", "Dockerin"]))
+        if random.random() < 0.3:
+            subfam[seqid] = ["3.2.1.%s" % random.randint(1, 200), random.choice(families)]
+        r.append("|".join([seqid] + types))
+
+    return activ, subfam, r
+
+
+def synthetic_cazy(file, lines, subjects, seed=1):
+
+    random.seed(seed + 1)
+    with open(file, "w") as fh:
+        for n in range(lines):
+            refseq = random.choice(subjects)
+            fh.write("gene%s\t%s\t%s\t%s\t1e-%s\t%.1f\t%s\n" % (
+                n, refseq, random.randint(1, 100), random.randint(150, 600),
+                random.randint(5, 80), random.uniform(30, 500), refseq))
+
+    return file
+
+
+def legacy_resolve(refseq, title, activ_dict, subfam_dit):
+    """
+    the per line family parsing of output_cazy before create_resolver
+    """
+    temp = refseq.split('|')
+    seqid = temp[0]
+
+    notes = []
+    classs = []
+    descs = []
+    for typeid in cut_type(temp[1::]):
+        if typeid in activ_dict:
+            if typeid in notes:
+                continue
+            notes.append(typeid)
+            descs.append(activ_dict[typeid])
+            classs.append(re.search("(\D+)", typeid).group(1))
+        else:
+            if typeid not in CAZY_CLASS:
+                continue
+            notes.append(typeid)
+            descs.append(title)
+            classs.append(typeid)
+
+    if seqid in subfam_dit:
+        typeid = subfam_dit[seqid][1]
+        if typeid not in notes and typeid in activ_dict:
+            notes.append(typeid)
+            classs.append(re.search("(\D+)", typeid).group(1))
+            descs.append(activ_dict[typeid])
+
+    return ";".join(notes), ";".join(classs), ";".join(descs), tuple(classs)
+
+
+def run_method(file, resolve):
+
+    digest = hashlib.md5()
+    n = 0
+
+    start = time.time()
+    for line in read_tsv(file, "\t"):
+        r = resolve(line[1].strip(), line[-1])
+        digest.update(("%s\t%s\n" % (line[0], "\t".join(r[:3]))).encode())
+        n += 1
+
+    return time.time() - start, n, digest.hexdigest()
+
+
+def bench_cazyproc(lines, subjects, repeat=3, file=""):
+
+    activ, subfam, refseqs = synthetic_tables(subjects)
+    temp = not file
+    if temp:
+        fd, file = tempfile.mkstemp(suffix=".CAZy.out")
+        os.close(fd)
+    try:
+        synthetic_cazy(file, lines, refseqs)
+        LOG.info("%s hits of %s subjects in %s" % (lines, subjects, file))
+
+        methods = [
+            ("legacy", lambda: lambda refseq, title: legacy_resolve(refseq, title, activ, subfam)),
+            ("resolver", lambda: create_resolver(activ, subfam)),
+        ]
+        expect = None
+        print("#method\tbest time(s)\thits/s")
+        for name, method in methods:
+            times = []
+            for i in range(repeat):
+                elapsed, n, digest = run_method(file, method())
+                times.append(elapsed)
+            if expect is None:
+                expect = digest
+            elif digest != expect:
+                raise Exception("%s does not match the output of %s" % (name, methods[0][0]))
+            print("%s\t%.3f\t%.0f" % (name, min(times), n/max(min(times), 1e-9)))
+    finally:
+        if temp:
+            os.remove(file)
+
+    return 0
+
+
+def add_hlep_args(parser):
+
+    parser.add_argument("--lines", metavar="INT", type=int, default=1000000,
+        help="Number of hits of the synthetic CAZy.out, default=1000000")
+    parser.add_argument("--subjects", metavar="INT", type=int, default=20000,
+        help="Number of distinct subjects of the hits, default=20000")
+    parser.add_argument("--repeat", metavar="INT", type=int, default=3,
+        help="Number of runs of each method, default=3")
+    parser.add_argument("--keep", metavar="FILE", type=str, default="",
+        help="Write the synthetic CAZy.out to FILE and keep it")
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''
+name:
+    bench_cazyproc.py: Benchmark the family parsing of cazyproc.py on a synthetic CAZy.out
+
+attention:
+    bench_cazyproc.py --lines 1000000 --subjects 20000
+
+version: %s
+contact:  %s <%s>\
+        ''' % (__version__, ' '.join(__author__), __email__))
+
+    args = add_hlep_args(parser).parse_args()
+    bench_cazyproc(args.lines, args.subjects, args.repeat, args.keep)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import random
+import argparse
+import logging
+
+from find_pul import find_gene_family, find_gene_family_numpy, np
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+
+def synthetic_contig(genes, density, seed=1):
+    """
+    positions of the annotated genes of a contig, dense runs of annotated
+    genes broken by gaps of unannotated genes
+    """
+    random.seed(seed)
+    r = []
+    dense = False
+
+    for i in range(1, genes+1):
+        if random.random() < 0.05:
+            dense = not dense
+        if random.random() < (0.95 if dense else density):
+            r.append(i)
+
+    return r
+
+
+def legacy_find_gene_family(glist, gaplen=2, minegene=2, gaps=1):
+    """
+    find_gene_family before the single-pass scanner
+    """
+    r = []
+    temp = []
+    gs = 0
+
+    for i in sorted(glist):
+        if not temp:
+            temp.append(i)
+            continue
+        if i <= (max(temp)+1):
+            temp.append(i)
+        elif i <= (max(temp)+gaplen+1):
+            gs += 1
+            if gs >= (gaps+1):
+                if len(temp) >= minegene:
+                    r.append(temp)
+                gs = 0
+                temp = [i]
+            else:
+                temp.append(i)
+        else:
+            if len(temp) >= minegene:
+                r.append(temp)
+            gs = 0
+            temp = [i]
+    if len(temp) >= minegene:
+        r.append(temp)
+
+    return r
+
+
+def scanner_find_gene_family(glist, gaplen=2, minegene=2, gaps=1):
+
+    import find_pul
+
+    numpy_genes = find_pul.NUMPY_GENES
+    find_pul.NUMPY_GENES = 0
+    try:
+        return find_gene_family(glist, gaplen, minegene, gaps)
+    finally:
+        find_pul.NUMPY_GENES = numpy_genes
+
+
+def bench_find_pul(genes, density, gaplen, minegene, gaps, repeat=3, legacy=True):
+
+    glist = synthetic_contig(genes, density)
+    LOG.info("%s genes, %s annotated" % (genes, len(glist)))
+
+    methods = [("scanner", scanner_find_gene_family)]
+    if np is not None:
+        methods.append(("numpy", find_gene_family_numpy))
+    if legacy:
+        methods.insert(0, ("legacy", legacy_find_gene_family))
+
+    expect = None
+    print("#method\tbest time(s)\tgenes/s\tclusters")
+    for name, method in methods:
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            r = method(glist, gaplen, minegene, gaps)
+            times.append(time.time() - start)
+        if expect is None:
+            expect = r
+        elif r != expect:
+            raise Exception("%s does not match the clusters of %s" % (name, methods[0][0]))
+        print("%s\t%.3f\t%.0f\t%s" % (name, min(times), len(glist)/max(min(times), 1e-9), len(r)))
+
+    return 0
+
+
+def add_hlep_args(parser):
+
+    parser.add_argument("--genes", metavar="INT", type=int, default=300000,
+        help="Number of genes of the synthetic contig, default=300000")
+    parser.add_argument("--density", metavar="FLOAT", type=float, default=0.3,
+        help="Fraction of annotated genes outside the dense runs, default=0.3")
+    parser.add_argument("-gl", "--gaplen", metavar="INT", type=int, default=4,
+        help="Maximum allowable gap size, default=4")
+    parser.add_argument("-mg", "--minegene", metavar="INT", type=int, default=2,
+        help="Minimum number of genes allowed, default=2")
+    parser.add_argument("-g", "--gaps", metavar="INT", type=int, default=3,
+        help="Minimum number of gaps allowed, default=3")
+    parser.add_argument("--repeat", metavar="INT", type=int, default=3,
+        help="Number of runs of each method, default=3")
+    parser.add_argument("--skip_legacy", action="store_true",
+        help="Do not run the quadratic find_gene_family")
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''
+name:
+    bench_find_pul.py: Benchmark the gene cluster scanners of find_pul.py on a synthetic contig
+
+attention:
+    bench_find_pul.py --genes 300000 --gaplen 4 --gaps 3
+
+version: %s
+contact:  %s <%s>\
+        ''' % (__version__, ' '.join(__author__), __email__))
+
+    args = add_hlep_args(parser).parse_args()
+    bench_find_pul(args.genes, args.density, args.gaplen, args.minegene,
+                   args.gaps, args.repeat, not args.skip_legacy)
+
+
+if __name__ == "__main__":
+
+    main()
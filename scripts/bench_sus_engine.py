@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import gzip
+import time
+import random
+import argparse
+import logging
+import tempfile
+import subprocess
+
+from hmm_sus import hmm_sus
+from blast_filter import filter_blastp, np
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+OUTFMT = ["std", "qlen", "slen", "stitle"]
+# the filter of the SUS hits of findPUL.py, FILTER_OUT["sus"]
+SUS_OUT = ["qseqid", "sseqid", "qstart", "qend", "stitle", "evalue", "bitscore"]
+SUS_FASTA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         "database", "SusC.pep.fasta.gz")
+
+
+def read_fasta(file):
+
+    fh = gzip.open(file, "rt") if file.endswith(".gz") else open(file)
+    seqid, seq = "", []
+
+    for line in fh:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(">"):
+            if seqid:
+                yield seqid, "".join(seq)
+            seqid, seq = line[1:].split()[0], []
+            continue
+        seq.append(line)
+    if seqid:
+        yield seqid, "".join(seq)
+    fh.close()
+
+
+def sample_fasta(file, number, out, seed=1):
+    """
+    a random sample of the sequences as the queries, the family of a query
+    is the #family of its name (A0A5C6S913_9RHOB|98-285#SusC)
+    """
+    random.seed(seed)
+    r = []
+
+    for n, record in enumerate(read_fasta(file)):
+        if len(r) < number:
+            r.append(record)
+        elif random.random() < number/(n+1.0):
+            r[random.randrange(number)] = record
+
+    labels = {}
+    with open(out, "w") as fh:
+        for seqid, seq in r:
+            fh.write(">%s\n%s\n" % (seqid, seq))
+            labels[seqid] = seqid.split("#")[-1] if "#" in seqid else ""
+
+    return labels
+
+
+def filter_family(file, out, evalue, coverage):
+    """
+    filter the m6 as findPUL.py does for sus.out, the family of each query
+    is the last one kept, as merge_puldb.py reads it
+    """
+    r = {}
+
+    with open(out, "w") as fh:
+        fh.write("#%s\n" % "\t".join(SUS_OUT))
+        for line in filter_blastp(file, "numpy" if np else "python", evalue, 0, True, 0,
+                                  coverage, 0, OUTFMT, SUS_OUT):
+            fh.write("%s\n" % line)
+            line = line.split("\t")
+            r[line[0]] = line[1].split("#")[-1]
+
+    return r
+
+
+def run_blastp(query, db, out, threads, evalue, blastp):
+
+    command = [blastp, "-query", query, "-db", db, "-outfmt", "6 std qlen slen stitle",
+               "-max_target_seqs", "5", "-evalue", str(evalue), "-num_threads", str(threads), "-out", out]
+    LOG.info(" ".join(command))
+    start = time.time()
+    subprocess.check_call(command)
+
+    return time.time() - start
+
+
+def run_hmm(query, hmm, out, threads, evalue, hmmsearch):
+
+    start = time.time()
+    hmm_sus(query, hmm, out, threads, evalue, hmmsearch)
+
+    return time.time() - start
+
+
+def bench_sus_engine(file, number, db, hmm, threads=1, evalue=1e-05, coverage=30,
+                     blast_bin="", hmmer_bin="", keep=""):
+
+    work = keep or tempfile.mkdtemp(prefix="bench_sus.")
+    if not os.path.exists(work):
+        os.makedirs(work)
+    query = os.path.join(work, "query.fasta")
+    labels = sample_fasta(file, number, query)
+    LOG.info("%s queries of %s in %s" % (len(labels), file, query))
+
+    calls = {}
+    print("#engine\ttime(s)\tqueries/s\tcalled\tlabel agree")
+    for name, method, target, program in [
+            ("blastp", run_blastp, db, os.path.join(blast_bin, "blastp")),
+            ("hmm", run_hmm, hmm, os.path.join(hmmer_bin, "hmmsearch"))]:
+        m6 = os.path.join(work, "%s.m6" % name)
+        elapsed = method(query, target, m6, threads, evalue, program)
+        calls[name] = filter_family(m6, os.path.join(work, "%s.sus.out" % name), evalue, coverage)
+        agree = sum(1 for k, v in calls[name].items() if v == labels.get(k))
+        print("%s\t%.2f\t%.1f\t%s\t%s" % (
+            name, elapsed, len(labels)/max(elapsed, 1e-9), len(calls[name]), agree))
+
+    blastp, hmm = calls["blastp"], calls["hmm"]
+    both = set(blastp) & set(hmm)
+    same = sum(1 for k in both if blastp[k] == hmm[k])
+    print("#concordance\tqueries")
+    print("both\t%s" % len(both))
+    print("same family\t%s" % same)
+    print("blastp only\t%s" % len(set(blastp) - both))
+    print("hmm only\t%s" % len(set(hmm) - both))
+    print("neither\t%s" % (len(labels) - len(set(blastp) | set(hmm))))
+
+    if not keep:
+        for name in os.listdir(work):
+            os.remove(os.path.join(work, name))
+        os.rmdir(work)
+
+    return 0
+
+
+def add_hlep_args(parser):
+
+    parser.add_argument("input", metavar="FILE", type=str, nargs="?", default=SUS_FASTA,
+        help="Input the SUS proteins with the family in the name(fasta, gz), default=%s" % SUS_FASTA)
+    parser.add_argument("-n", "--number", metavar="INT", type=int, default=2000,
+        help="Number of sampled queries, default=2000")
+    parser.add_argument("--db", metavar="FILE", type=str, required=True,
+        help="Input the blastp database of the SUS proteins, GDB")
+    parser.add_argument("--hmm", metavar="FILE", type=str, required=True,
+        help="Input the models of the SUS families, SUS.hmm")
+    parser.add_argument("-t", "--threads", metavar="INT", type=int, default=4,
+        help="Number of threads of both engines, default=4")
+    parser.add_argument("-e", "--evalue", metavar="NUM", type=float, default=1e-05,
+        help="Evalue cutoff, default=1e-05")
+    parser.add_argument("-c", "--coverage", metavar="NUM", type=float, default=30,
+        help="Coverage cutoff of the queries as in findPUL.py, default=30")
+    parser.add_argument("--blast_bin", metavar="DIR", type=str, default="",
+        help="Directory of blastp, default is in PATH")
+    parser.add_argument("--hmmer_bin", metavar="DIR", type=str, default="",
+        help="Directory of hmmsearch, default is in PATH")
+    parser.add_argument("--keep", metavar="DIR", type=str, default="",
+        help="Write the queries and the hits to DIR and keep them")
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''
+name:
+    bench_sus_engine.py: Benchmark the speed and concordance of the blastp and hmm SUS engines
+
+attention:
+    bench_sus_engine.py database/SusC.pep.fasta.gz --db database/SUS --hmm database/SUS.hmm -n 2000
+
+version: %s
+contact:  %s <%s>\
+        ''' % (__version__, ' '.join(__author__), __email__))
+
+    args = add_hlep_args(parser).parse_args()
+    bench_sus_engine(args.input, args.number, args.db, args.hmm, args.threads,
+                     args.evalue, args.coverage, args.blast_bin, args.hmmer_bin, args.keep)
+
+
+if __name__ == "__main__":
+
+    main()
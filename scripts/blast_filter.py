@@ -1,10 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import sys
 import argparse
 import logging
 
+from functools import partial
+from operator import itemgetter
+from multiprocessing import Pool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 LOG = logging.getLogger(__name__)
 
 __version__ = "0.1.0"
@@ -12,6 +22,8 @@ __author__ = ("Junpeng Fan",)
 __email__ = "jpfan@whu.edu.cn"
 __all__ = []
 
+NUMBER_FIELDS = ["pident", "mismatch", "gapopen", "qstart", "qend", "sstart", "send", "evalue", "bitscore"]
+
 
 def read_tsv(file):
 
@@ -121,10 +133,10 @@ def _overlap(range_list):
     r = []
     p = [None, None]
 
-    for start, end in sorted(range_list, key=lambda d: min(d)):
+    # ranges are oriented first, sorting on start is then the same as on min
+    ranges = [(start, end) if start <= end else (end, start) for start, end in range_list]
 
-        if start > end:
-            start, end = end, start
+    for start, end in sorted(ranges, key=itemgetter(0)):
 
         if p[0] is None:
             p = [start, end]
@@ -140,27 +152,52 @@ def _overlap(range_list):
     return r
 
 
-def calculate_cov(hit, outfmt):
+def _coverage(starts, ends, length):
+    """
+    percent of length covered by the ranges, a single range needs no merge
+    """
+    if len(starts) == 1:
+        return (abs(ends[0] - starts[0]) + 1) * 100.0 / length
+
+    return sum([i[1]-i[0]+1 for i in _overlap(zip(starts, ends))])*100.0/length
 
-    qhit = [[int(i[outfmt["qstart"]]), int(i[outfmt["qend"]])] for i in hit]
-    shit = [[int(i[outfmt["sstart"]]), int(i[outfmt["send"]])] for i in hit]
 
-    qcov = sum([i[1]-i[0]+1 for i in _overlap(qhit)])*100.0/int(hit[0][outfmt["qlen"]])
-    scov = sum([i[1]-i[0] + 1 for i in _overlap(shit)]) * 100.0 / int(hit[0][outfmt["slen"]])
+def calculate_cov(hit, outfmt, query=True, subject=True):
+    """
+    coverage of the hit on query and subject, an axis not asked is None
+    """
+    qcov = scov = None
+
+    if query:
+        qcov = _coverage([int(i[outfmt["qstart"]]) for i in hit],
+                         [int(i[outfmt["qend"]]) for i in hit],
+                         int(hit[0][outfmt["qlen"]]))
+    if subject:
+        scov = _coverage([int(i[outfmt["sstart"]]) for i in hit],
+                         [int(i[outfmt["send"]]) for i in hit],
+                         int(hit[0][outfmt["slen"]]))
 
     return qcov, scov
 
 
 def filter_hit_with_cov(hits, qcov, scov, outfmt):
 
+    # coverage is always positive, an axis with a cutoff <= 0 is not computed
+    query = qcov > 0
+    subject = scov > 0
+
     for hit in hits:
-        _qcov, _scov = calculate_cov(hit, outfmt)
+        _qcov, _scov = calculate_cov(hit, outfmt, query, subject)
 
-        if _qcov >= qcov and _scov >= scov:
-            yield hit
+        if query and _qcov < qcov:
+            continue
+        if subject and _scov < scov:
+            continue
 
+        yield hit
 
-def process_blastp(file, evalue, pident, best, best_evalue, qcov, scov, outfmt, out):
+
+def parse_outfmt(outfmt):
 
     out_fmt = {}
 
@@ -172,7 +209,43 @@ def process_blastp(file, evalue, pident, best, best_evalue, qcov, scov, outfmt,
     for i, q in enumerate(outfmt):
         out_fmt[q] = i
 
-    outfmt = out_fmt
+    return out_fmt
+
+
+def compile_out(out, outfmt):
+    """
+    resolve the output fields once, return a function that formats a hit
+    as one output line, the values of the hsps are joined with ';' and
+    deduplicated in order, except for the fields in NUMBER_FIELDS
+    """
+    index = [outfmt[n] for n in out]
+    dedup = [n not in NUMBER_FIELDS for n in out]
+    fields = list(zip(index, dedup))
+    template = "\t".join(["{}"] * len(out))
+
+    def project(hit):
+
+        if len(hit) == 1:
+            hsp = hit[0]
+            return template.format(*[hsp[i] for i in index])
+
+        r = []
+        for i, unique in fields:
+            values = [hsp[i] for hsp in hit]
+
+            if unique:
+                values = dict.fromkeys(values)
+
+            r.append(";".join(values))
+
+        return template.format(*r)
+
+    return project
+
+
+def process_blastp(file, evalue, pident, best, best_evalue, qcov, scov, outfmt, out):
+
+    outfmt = parse_outfmt(outfmt)
     data = read_tsv(file)
 
     data = cluster_hsp(filter_hsp_with_evalue_ident(data, evalue=evalue, pident=pident, outfmt=outfmt), outfmt)
@@ -186,26 +259,290 @@ def process_blastp(file, evalue, pident, best, best_evalue, qcov, scov, outfmt,
     if qcov or scov:
         data = filter_hit_with_cov(data, qcov=qcov, scov=scov, outfmt=outfmt)
 
-    print("#%s" % "\t".join(out))
+    project = compile_out(out, outfmt)
 
     for hit in data:
-        r = []
+        yield project(hit)
+
+
+def read_block(file, size=64):
+    """
+    read a file in blocks of about size MB that end at a line break
+    """
+    size = int(size * 1024 * 1024)
+    if size < 1:
+        raise Exception("the block size of %s is under 1 byte, raise --chunk" % file)
+    fh = open(file, "rb")
+    rest = b""
+
+    while True:
+        data = fh.read(size)
+        if not data:
+            break
+
+        data = rest + data
+        i = data.rfind(b"\n") + 1
+        if not i:
+            rest = data
+            continue
+
+        rest = data[i:]
+        yield data[:i]
+
+    fh.close()
+
+    if rest:
+        yield rest + b"\n"
+
+
+def _clean_block(data, outfmt):
+    """
+    strip the lines of a block, drop comments and lines not match outfmt,
+    as read_tsv and filter_hsp_with_evalue_ident do
+    """
+    n = len(outfmt)
+    lines = []
+
+    for line in io.StringIO(data.decode("utf-8"), newline=None):
+        line = line.strip()
+
+        if not line or line.startswith("#"):
+            continue
+
+        if line.count("\t") != n - 1:
+            LOG.warning("%r not match %s" % (line.split("\t"), outfmt))
+            continue
+
+        lines.append(line)
+
+    return "".join("%s\n" % i for i in lines).encode("utf-8")
+
+
+def _parse_block(data, outfmt):
+    """
+    locate the fields of a block of hsps, return the byte buffer and the
+    start and end offsets of each field (rows x fields), or None if the
+    block has lines that must be cleaned first
+    """
+    n = len(outfmt)
+    buf = np.frombuffer(data, dtype=np.uint8)
+
+    breaks = np.flatnonzero(buf == 10)
+    seps = np.flatnonzero((buf == 9) | (buf == 10))
+    if not len(breaks) or len(seps) != len(breaks) * n or (buf == 13).any():
+        return None
+
+    ends = seps.reshape(-1, n)
+    if (ends[:, -1] != breaks).any():
+        return None
+
+    starts = np.empty_like(ends)
+    starts[0, 0] = 0
+    starts[1:, 0] = breaks[:-1] + 1
+    starts[:, 1:] = ends[:, :-1] + 1
+
+    # empty lines, comments and whitespace around a line go to _clean_block
+    line_start = starts[:, 0]
+    line_end = ends[:, -1]
+    if (line_end <= line_start).any():
+        return None
+
+    edge = np.concatenate([buf[line_start], buf[line_end - 1]])
+    if (edge == 35).any() or (edge <= 32).any():
+        return None
+
+    # a line may start or end with a multi-byte character, only unicode
+    # whitespace there has to be stripped by _clean_block
+    for i in np.flatnonzero((edge >= 128).reshape(2, -1).any(axis=0)).tolist():
+        line = data[line_start[i]:line_end[i]].decode("utf-8")
+        if line != line.strip():
+            return None
+
+    return buf, starts, ends
+
+
+def _field(block, i, rows=None):
+    """
+    field i of a parsed block as a fixed width bytes array
+    """
+    buf, starts, ends = block
+    starts, ends = starts[:, i], ends[:, i]
 
-        for n in out:
-            s = []
+    if rows is not None:
+        starts, ends = starts[rows], ends[rows]
+    if not len(starts):
+        return np.array([], dtype="S1")
 
-            for hsp in hit:
-                mes = hsp[outfmt[n]]
+    width = max(int((ends - starts).max()), 1)
+    index = starts[:, None] + np.arange(width)
+    chars = buf.take(index, mode="clip")
+    chars[index >= ends[:, None]] = 0
 
-                if mes not in s:
-                    s.append(mes)
-                else:
-                    if n in ["pident", "mismatch", "gapopen", "qstart", "qend", "sstart", "send", "evalue", "bitscore"]:
-                        s.append(mes)
+    return chars.view("S%d" % width).ravel()
 
-            r.append(";".join(s))
 
-        yield r
+def _lines(block, rows):
+
+    buf, starts, ends = block
+    data = buf.base
+
+    return [data[starts[i, 0]:ends[i, -1]].decode("utf-8") for i in rows]
+
+
+def _starts(*keys):
+    """
+    mark the rows where any of the keys differ from the previous row
+    """
+    r = np.zeros(len(keys[0]), dtype=bool)
+    r[0] = True
+
+    for key in keys:
+        r[1:] |= key[1:] != key[:-1]
+
+    return r
+
+
+def _expand(starts, ends):
+    """
+    concatenate the ranges starts[i]:ends[i]
+    """
+    lengths = ends - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+
+    return offsets + np.arange(lengths.sum())
+
+
+def _block_cov(block, rows, starts, ends, start, end, length):
+    """
+    coverage of each hit on one axis, single-hsp hits are computed in one
+    vectorized step and multi-hsp hits fall back to _coverage
+    """
+    index = rows[starts]
+    first = _field(block, start, index).astype(np.int64)
+    last = _field(block, end, index).astype(np.int64)
+    lengths = _field(block, length, index).astype(np.int64)
+    cov = (np.abs(last - first) + 1) * 100.0 / lengths
+
+    multi = np.flatnonzero(ends - starts > 1)
+    if not len(multi):
+        return cov
+
+    index = rows[_expand(starts[multi], ends[multi])]
+    first = _field(block, start, index).astype(np.int64).tolist()
+    last = _field(block, end, index).astype(np.int64).tolist()
+    n = 0
+
+    for i, hsps in zip(multi.tolist(), (ends - starts)[multi].tolist()):
+        cov[i] = _coverage(first[n:n+hsps], last[n:n+hsps], int(lengths[i]))
+        n += hsps
+
+    return cov
+
+
+def _process_block(block, rows, hsp_evalue, best, best_evalue, qcov, scov, outfmt, out):
+
+    qseqid = _field(block, outfmt["qseqid"], rows)
+    hit = np.flatnonzero(_starts(qseqid, _field(block, outfmt["sseqid"], rows)))
+    ends = np.append(hit[1:], len(rows))
+    first = _starts(qseqid)[hit]
+    keep = np.ones(len(hit), dtype=bool)
+
+    if best_evalue:
+        run = np.cumsum(first) - 1
+        hit_evalue = hsp_evalue[hit]
+        keep &= first | (hit_evalue <= hit_evalue[first][run] * best_evalue)
+
+    if best:
+        keep &= first
+
+    hit, ends = hit[keep], ends[keep]
+
+    if qcov > 0:
+        keep = _block_cov(block, rows, hit, ends, outfmt["qstart"], outfmt["qend"], outfmt["qlen"]) >= qcov
+        hit, ends = hit[keep], ends[keep]
+
+    if scov > 0:
+        keep = _block_cov(block, rows, hit, ends, outfmt["sstart"], outfmt["send"], outfmt["slen"]) >= scov
+        hit, ends = hit[keep], ends[keep]
+
+    project = compile_out(out, outfmt)
+    lines = iter(_lines(block, rows[_expand(hit, ends)]))
+
+    for start, end in zip(hit.tolist(), ends.tolist()):
+        yield project([next(lines).split("\t") for i in range(end - start)])
+
+
+def process_blastp_numpy(file, evalue, pident, best, best_evalue, qcov, scov, outfmt, out, size=64):
+    """
+    same as process_blastp, but locate the fields of each block of the file
+    with numpy, filter the hsps as typed arrays and group them on qseqid with
+    vectorized operations, only the lines of the hits kept are decoded
+    """
+    outfmt = parse_outfmt(outfmt)
+
+    assert "evalue" in outfmt
+    assert "pident" in outfmt
+    assert "qseqid" in outfmt
+    assert "sseqid" in outfmt
+
+    LOG.info("filter with evalue <= %s and pident >= %s" % (evalue, pident))
+
+    pending = b""
+
+    for data in read_block(file, size):
+        data = pending + data
+
+        block = _parse_block(data, outfmt)
+        if block is None:
+            clean = _clean_block(data, outfmt)
+            # a block of comments or malformed lines only, pending is kept
+            if not clean:
+                continue
+            block = _parse_block(clean, outfmt)
+            if block is None:
+                raise Exception("cannot parse a block of %s after cleaning" % file)
+        pending = b""
+
+        hsp_evalue = _field(block, outfmt["evalue"]).astype(np.float64)
+        hsp_pident = _field(block, outfmt["pident"]).astype(np.float64)
+        rows = np.flatnonzero((hsp_evalue <= evalue) & (hsp_pident >= pident))
+        if not len(rows):
+            continue
+
+        # the hsps of the last query are carried to the next block
+        tail = np.flatnonzero(_starts(_field(block, outfmt["qseqid"], rows)))[-1]
+        pending = "".join("%s\n" % i for i in _lines(block, rows[tail:])).encode("utf-8")
+
+        rows = rows[:tail]
+        if len(rows):
+            for r in _process_block(block, rows, hsp_evalue[rows], best, best_evalue, qcov, scov, outfmt, out):
+                yield r
+
+    if pending:
+        block = _parse_block(pending, outfmt)
+        rows = np.arange(len(block[1]))
+        hsp_evalue = _field(block, outfmt["evalue"]).astype(np.float64)
+        for r in _process_block(block, rows, hsp_evalue, best, best_evalue, qcov, scov, outfmt, out):
+            yield r
+
+
+def filter_blastp(file, engine, evalue, pident, best, best_evalue, qcov, scov, outfmt, out, chunk=64):
+
+    if engine == "numpy":
+        if np is None:
+            raise Exception("numpy is required by --engine numpy")
+        return process_blastp_numpy(file, evalue, pident, best, best_evalue, qcov, scov, outfmt, out, chunk)
+
+    return process_blastp(file, evalue, pident, best, best_evalue, qcov, scov, outfmt, out)
+
+
+def filter_shard(file, **kwargs):
+    """
+    filter one shard of a blast result, return the lines of the hits kept
+    """
+    LOG.info("filter %s" % file)
+
+    return "".join("%s\n" % i for i in filter_blastp(file, **kwargs))
 
 
 def set_args():
@@ -217,7 +554,8 @@ version: %s
 contact:  %s <%s>\
     """ % (__version__, " ".join(__author__), __email__))
 
-    args.add_argument("blast", help="")
+    args.add_argument("blast", nargs="+",
+                      help="blast results, the hits of a query must not span files")
     args.add_argument("--best", action="store_true",
                       help="only get the best hit")
     args.add_argument("--best_evalue", type=float, metavar="NUM", default="1",
@@ -241,6 +579,12 @@ contact:  %s <%s>\
                       default=["qseqid", "sseqid"],
                       help="output field of blast result (default: qseqid sseqid)"
                       )
+    args.add_argument("--engine", choices=["python", "numpy"], default="numpy" if np else "python",
+                      help="filter line by line in python or in blocks with numpy (default: numpy if installed)")
+    args.add_argument("--chunk", type=float, metavar="NUM", default=64,
+                      help="block size in MB of the numpy engine (default: 64)")
+    args.add_argument("--jobs", type=int, metavar="INT", default=1,
+                      help="number of blast results filtered at the same time (default: 1)")
 
     return args.parse_args()
 
@@ -254,9 +598,24 @@ def main():
     )
 
     args = set_args()
+    kwargs = dict(engine=args.engine, evalue=args.evalue, pident=args.min_pident,
+                  best=args.best, best_evalue=args.best_evalue, qcov=args.min_qcov,
+                  scov=args.min_scov, outfmt=args.outfmt, out=args.out, chunk=args.chunk)
+
+    print("#%s" % "\t".join(args.out))
+
+    if args.jobs > 1 and len(args.blast) > 1:
+        pool = Pool(processes=min(args.jobs, len(args.blast)))
+
+        for i in pool.imap(partial(filter_shard, **kwargs), args.blast):
+            sys.stdout.write(i)
 
-    for i in process_blastp(args.blast, args.evalue, args.min_pident, args.best, args.best_evalue, args.min_qcov, args.min_scov, args.outfmt, args.out):
-        print("\t".join(i))
+        pool.close()
+        pool.join()
+    else:
+        for file in args.blast:
+            for i in filter_blastp(file, **kwargs):
+                print(i)
 
 
 if __name__ == "__main__":
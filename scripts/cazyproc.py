@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import re
 import sys
+import gzip
+import json
+import mmap
+import struct
 import argparse
 import logging
 
-from collections import OrderedDict
+from array import array
+from functools import lru_cache
+from collections import OrderedDict, Counter
 
 LOG = logging.getLogger(__name__)
 
@@ -26,6 +33,11 @@ CAZY_CLASS = {
     "Cohesin": "Cohesin domain",
     "Dockerin": "Dockerin domain"}
 CAZY_KEY = ["GH", "GT", "PL", "CE", "AA", "CBM", "SLH", "Cohesin", "Dockerin"]
+FAMILY_RE = re.compile(r"(\D+)")
+DIGIT_RE = re.compile(r"\d+")
+CACHE_SIZE = 65536
+INDEX_MAGIC = b"CAZYIDX1"
+INDEX_VERSION = 1
 
 def read_tsv(file, sep=None):
 
@@ -60,6 +72,173 @@ def read_subfam(file):
     return subfam_dit
 
 
+def source_stat(file):
+
+    if not file:
+        return None
+    stat = os.stat(file)
+
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def compile_tables(activ, subfam, index):
+    """
+    compile the activities and subfamilies into a binary index, a table is
+    an array of the offsets of its sorted keys and one of its values in a
+    string pool, the values of the subfamilies are ec and family
+    """
+    tables = [("activ", read_activ(activ))]
+    if subfam:
+        tables.append(("subfam", dict((k, "\t".join(v)) for k, v in read_subfam(subfam).items())))
+    else:
+        tables.append(("subfam", {}))
+
+    header = {"version": INDEX_VERSION, "byteorder": sys.byteorder,
+              "sources": [source_stat(activ), source_stat(subfam)], "tables": {}}
+    pool = bytearray()
+    offsets = []
+    for name, table in tables:
+        keys = sorted((k.encode("utf-8"), v) for k, v in table.items())
+        key_offsets = array("I", [0] * (len(keys)+1))
+        value_offsets = array("I", [0] * (len(keys)+1))
+        for field, index_offsets in [(0, key_offsets), (1, value_offsets)]:
+            index_offsets[0] = len(pool)
+            for n, record in enumerate(keys, 1):
+                value = record[field]
+                pool += value if field == 0 else value.encode("utf-8")
+                index_offsets[n] = len(pool)
+        header["tables"][name] = len(keys)
+        offsets += [key_offsets, value_offsets]
+
+    header = json.dumps(header).encode("utf-8")
+    with open(index, "wb") as fh:
+        fh.write(INDEX_MAGIC + struct.pack("<I", len(header)) + header)
+        # align the offset arrays of the mapped file
+        fh.write(b"\0" * (-fh.tell() % 4))
+        for i in offsets:
+            fh.write(i.tobytes())
+        fh.write(pool)
+    LOG.info("compile %s activities and %s subfamilies to %s" % (
+        len(tables[0][1]), len(tables[1][1]), index))
+
+    return index
+
+
+class MappedTable(object):
+    """
+    a read only dict of a table of the binary index, the keys are found by
+    binary search on the mapped file
+    """
+
+    def __init__(self, buffer, keys, values, pool, fields=1):
+
+        self.buffer = buffer
+        self.keys = keys
+        self.values = values
+        self.pool = pool
+        self.fields = fields
+
+    def __len__(self):
+
+        return len(self.keys) - 1
+
+    def _key(self, i):
+
+        return self.buffer[self.pool+self.keys[i]:self.pool+self.keys[i+1]]
+
+    def _find(self, key):
+
+        key = key.encode("utf-8")
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+            if self._key(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self) and self._key(low) == key:
+            return low
+        return -1
+
+    def __contains__(self, key):
+
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        value = self.buffer[self.pool+self.values[i]:self.pool+self.values[i+1]].decode("utf-8")
+        if self.fields > 1:
+            return value.split("\t")
+
+        return value
+
+    def get(self, key, default=None):
+
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def load_index(index, activ, subfam):
+    """
+    map the binary index of the tables, return None if the index is not of
+    this version or the tables changed after it was compiled
+    """
+    with open(index, "rb") as fh:
+        buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    size = len(INDEX_MAGIC) + 4
+    if buffer[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+        return None
+    length = struct.unpack("<I", buffer[len(INDEX_MAGIC):size])[0]
+    header = json.loads(buffer[size:size+length].decode("utf-8"))
+    if header["version"] != INDEX_VERSION or header["byteorder"] != sys.byteorder:
+        return None
+    if header["sources"] != [source_stat(activ), source_stat(subfam)]:
+        return None
+
+    offset = size + length
+    offset += -offset % 4
+    arrays = []
+    for name in ["activ", "subfam"]:
+        n = header["tables"][name]
+        for i in range(2):
+            arrays.append(memoryview(buffer)[offset:offset+4*(n+1)].cast("I"))
+            offset += 4*(n+1)
+
+    return (MappedTable(buffer, arrays[0], arrays[1], offset),
+            MappedTable(buffer, arrays[2], arrays[3], offset, 2))
+
+
+def read_tables(activ, subfam, index=""):
+    """
+    the activities and subfamilies, from the binary index if it is up to date
+    """
+    if index and os.path.exists(index):
+        tables = load_index(index, activ, subfam)
+        if tables:
+            LOG.info("map the tables of %s" % index)
+            return tables
+        LOG.warning("%s is not up to date with the tables, compile it with --compile" % index)
+
+    activ_dict = read_activ(activ)
+    if subfam:
+        subfam_dit = read_subfam(subfam)
+    else:
+        subfam_dit = {}
+
+    return activ_dict, subfam_dit
+
+
+def family_class(typeid):
+
+    return FAMILY_RE.search(typeid).group(1)
+
+
 def cut_type(tlist):
 
     r = []
@@ -67,31 +246,26 @@ def cut_type(tlist):
 
     for i in tlist:
         for j in i.split("_"):
-            try:
-                pr = re.search("(\D+)", j).group(1)
+            match = FAMILY_RE.search(j)
+            if match:
+                pr = match.group(1)
                 r.append(j)
-            except:
+            else:
                 r.append("%s%s" % (pr, j))
 
     return r
 
 
+def create_resolver(activ_dict, subfam_dit, maxsize=CACHE_SIZE):
+    """
+    the resolver of the families of a subject (sseqid, stitle), return the
+    notes, classes and descriptions, joined and as (note, class, desc) of
+    each family, the subjects repeat over the hits, so the results of the
+    recent ones are cached
+    """
+    @lru_cache(maxsize=maxsize)
+    def resolve(refseq, title):
 
-def output_cazy(cazy, activ, subfam, output):
-
-    activ_dict = read_activ(activ)
-    if subfam:
-        subfam_dit = read_subfam(subfam)
-    else:
-        subfam_dit = {}
-
-    cazy_dict = OrderedDict(GH=[], GT=[], PL=[], CE=[],
-                            AA=[], CBM=[], SLH=[],
-                            Cohesin=[], Dockerin=[])
-
-    print("#qseqid\tsseqid\tnote\tclass\tdesc")
-    for line in read_tsv(cazy, '\t'):
-        refseq = line[1].strip()
         temp = refseq.split('|')
         seqid = temp[0]
 
@@ -104,43 +278,103 @@ def output_cazy(cazy, activ, subfam, output):
                     continue
                 notes.append(typeid)
                 descs.append(activ_dict[typeid])
-                classs.append(re.search("(\D+)", typeid).group(1))
+                classs.append(family_class(typeid))
             else:
                 if typeid not in CAZY_CLASS:
                     continue
                 notes.append(typeid)
-                descs.append(line[-1])
+                descs.append(title)
                 classs.append(typeid)
-                
 
         if seqid in subfam_dit:
             typeid = subfam_dit[seqid][1]
-            if typeid in notes:
-                pass
-            else:
-                if typeid in activ_dict:
-                    notes.append(typeid)
-                    classs.append(re.search("(\D+)", typeid).group(1))
-                    descs.append(activ_dict[typeid])
-            
-        print("{}\t{}\t{}\t{}\t{}".format(line[0], refseq, ";".join(notes), ";".join(classs), ";".join(descs)))
-
-        for clasid in classs:
+            if typeid not in notes and typeid in activ_dict:
+                notes.append(typeid)
+                classs.append(family_class(typeid))
+                descs.append(activ_dict[typeid])
+
+        return ";".join(notes), ";".join(classs), ";".join(descs), tuple(zip(notes, classs, descs))
+
+    return resolve
+
+
+def family_key(family):
+
+    return CAZY_KEY.index(family[1]), [int(i) for i in DIGIT_RE.findall(family[0])], family[0]
+
+
+def open_output(file):
+
+    if file.endswith(".gz"):
+        return gzip.open(file, "wt")
+
+    return open(file, "w")
+
+
+def output_cazy(cazy, activ, subfam, output, index="", genes="", family=""):
+    """
+    annotate the hits and count the genes of each class. with genes, the
+    genes of the classes go to a long table (class, gene) and only the
+    counts stay in memory. with family, the counts of each family are
+    written too
+    """
+    activ_dict, subfam_dit = read_tables(activ, subfam, index)
+    resolve = create_resolver(activ_dict, subfam_dit)
+
+    cazy_dict = OrderedDict(GH=[], GT=[], PL=[], CE=[],
+                            AA=[], CBM=[], SLH=[],
+                            Cohesin=[], Dockerin=[])
+    class_counts = Counter()
+    family_counts = Counter()
+    family_descs = {}
+    if genes:
+        genes = open_output(genes)
+        genes.write("#class\tgene\n")
+
+    print("#qseqid\tsseqid\tnote\tclass\tdesc")
+    for line in read_tsv(cazy, '\t'):
+        refseq = line[1].strip()
+        notes, classs, descs, families = resolve(refseq, line[-1])
+
+        print("{}\t{}\t{}\t{}\t{}".format(line[0], refseq, notes, classs, descs))
+
+        for note, clasid, desc in families:
             if clasid not in cazy_dict:
                 continue
-            cazy_dict[clasid].append(line[0])
+            class_counts[clasid] += 1
+            family_counts[(note, clasid)] += 1
+            if note not in family_descs:
+                family_descs[note] = desc
+            if genes:
+                genes.write("{}\t{}\n".format(clasid, line[0]))
+            else:
+                cazy_dict[clasid].append(line[0])
+    LOG.info("resolve the families of the hits: %s" % (resolve.cache_info(),))
 
     output = open(output, "w")
 
-    output.write("#class\tnumber\tdesc\tgene\n")
-    for i in CAZY_KEY:
-        output.write("{}\t{}\t{}\t{}\n".format(i, len(cazy_dict[i]), CAZY_CLASS[i], ";".join(cazy_dict[i])))
+    if genes:
+        genes.close()
+        output.write("#class\tnumber\tdesc\n")
+        for i in CAZY_KEY:
+            output.write("{}\t{}\t{}\n".format(i, class_counts[i], CAZY_CLASS[i]))
+    else:
+        output.write("#class\tnumber\tdesc\tgene\n")
+        for i in CAZY_KEY:
+            output.write("{}\t{}\t{}\t{}\n".format(i, len(cazy_dict[i]), CAZY_CLASS[i], ";".join(cazy_dict[i])))
     output.close()
 
+    if family:
+        output = open(family, "w")
+        output.write("#family\tclass\tnumber\tdesc\n")
+        for i in sorted(family_counts, key=family_key):
+            output.write("{}\t{}\t{}\t{}\n".format(i[0], i[1], family_counts[i], family_descs[i[0]]))
+        output.close()
+
 
 def add_help(parser):
 
-    parser.add_argument('input', metavar='FILE', type=str,
+    parser.add_argument('input', metavar='FILE', type=str, nargs='?',
         help='Input the matching annotation file of CAZy, CAZy.out')
     parser.add_argument('--activ', metavar='FILE', type=str,  required=True,
         help='Input CAZy types of documentation, CAZy.activities.txt.')
@@ -148,6 +382,14 @@ def add_help(parser):
         help='Input the corresponding file of each id and classification of CAZy, CAZy.subfam.ec.txt')
     parser.add_argument('-o', '--output', metavar='STR', type=str, default='cazy_classify.tsv',
         help='The name of the output file.')
+    parser.add_argument('--genes', metavar='FILE', type=str, default="",
+        help='Write the genes of each class to FILE (class, gene; .gz is compressed), --output keeps only the counts')
+    parser.add_argument('--family', metavar='FILE', type=str, default="",
+        help='Write the number of genes of each family (GH13, GT2...) to FILE')
+    parser.add_argument('--index', metavar='FILE', type=str, default="",
+        help='Binary index of --activ and --subfam, used if it is up to date, CAZy.tables.idx')
+    parser.add_argument('--compile', action='store_true',
+        help='Compile --activ and --subfam into --index and exit')
 
     return parser
 
@@ -166,6 +408,9 @@ name:
 
 attention:
     cazyproc.py CAZy.out --activ CAZy.activities.txt --subfam CAZy.subfam.ec.txt -o cazy_classify.tsv >cazy.tsv
+    cazyproc.py --compile --activ CAZy.activities.txt --subfam CAZy.subfam.ec.txt --index CAZy.tables.idx
+    cazyproc.py CAZy.out --activ CAZy.activities.txt --subfam CAZy.subfam.ec.txt --index CAZy.tables.idx >cazy.tsv
+    cazyproc.py CAZy.out --activ CAZy.activities.txt --genes cazy_genes.tsv.gz --family cazy_family.tsv -o cazy_classify.tsv >cazy.tsv
 
 version: %s
 contact:  %s <%s>\
@@ -173,7 +418,14 @@ contact:  %s <%s>\
 
     args = add_help(parser).parse_args()
 
-    output_cazy(args.input, args.activ, args.subfam, args.output)
+    if args.compile:
+        if not args.index:
+            parser.error("--compile needs --index")
+        compile_tables(args.activ, args.subfam, args.index)
+        return
+    if not args.input:
+        parser.error("the input CAZy.out is required")
+    output_cazy(args.input, args.activ, args.subfam, args.output, args.index, args.genes, args.family)
 
 
 if __name__ == "__main__":
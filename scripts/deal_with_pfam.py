@@ -4,9 +4,17 @@
 import os
 import re
 import sys
+import gzip
+import math
+import heapq
+import zlib
 import logging
 import argparse
 
+from collections import Counter
+from itertools import chain
+from multiprocessing import Pool
+
 
 LOG = logging.getLogger(__name__)
 
@@ -20,46 +28,186 @@ def read_fasta(file):
 
     '''Read fasta file'''
     if file.endswith(".gz"):
-        fp = gzip.open(file)
+        fp = gzip.open(file, "rt")
     else:
         fp = open(file)
 
-    seq = []
+    seqid = ""
+    lines = []
     for line in fp:
-        if isinstance(line, bytes):
-            line = line.decode('utf-8')
         line = line.strip()
 
         if not line:
             continue
         if line.startswith(">"):
-            line = line.strip(">")
-            if len(seq) == 2:
-                yield seq
-            seq = []
-            seq.append(line.split()[0])
+            if lines:
+                yield [seqid, "".join(lines).upper()]
+            seqid = line.strip(">").split()[0]
+            lines = []
             continue
-        if len(seq) == 2:
-            seq[1] += line.upper()
-        else:
-            seq.append(line.upper())
+        lines.append(line)
 
-    if len(seq) == 2:
-        yield seq
+    if lines:
+        yield [seqid, "".join(lines).upper()]
     fp.close()
 
 
-def deal_with_pfam(files, describe="SusC"):
+def read_records(file):
+
+    return list(read_fasta(file))
+
+
+def read_files(files, jobs=1):
+    """
+    the sequences of the files in order, the files are read by jobs processes
+    """
+    if jobs > 1 and len(files) > 1:
+        pool = Pool(processes=min(jobs, len(files)))
+
+        for records in pool.imap(read_records, files):
+            for record in records:
+                yield record
+
+        pool.close()
+        pool.join()
+    else:
+        for file in files:
+            for record in read_fasta(file):
+                yield record
+
+
+def open_output(file):
+
+    if not file:
+        return sys.stdout
+    if file.endswith(".gz"):
+        # level 6 compresses about as well as 9 in a fraction of the time
+        return gzip.open(file, "wt", compresslevel=6)
+
+    return open(file, "w")
+
+
+def kmer_sketch(seq, kmer=5, size=64):
+    """
+    the bottom-k sketch of a sequence, the smallest hashes of its k-mers
+    """
+    kmers = set(seq[i:i+kmer] for i in range(len(seq)-kmer+1))
+
+    return heapq.nsmallest(size, [zlib.crc32(i.encode()) for i in kmers])
+
+
+def sketch_jaccard(a, b, size=64):
+    """
+    the Jaccard index of two sequences estimated from their sketches
+    """
+    both = set(a).intersection(b)
+    shared = 0
+    n = 0
+
+    for i in heapq.merge(a, sorted(set(b).difference(a))):
+        n += 1
+        if n > size:
+            break
+        if i in both:
+            shared += 1
+
+    return shared*1.0 / max(min(n, size), 1)
 
-    seqids = set()
 
-    for file in files:
-        for seqid,seq in read_fasta(file):
-            if seqid in seqids:
+def min_jaccard(identity, kmer=5):
+    """
+    the Jaccard index of two sequences of the identity, from the Mash distance
+    d = -ln(2j/(1+j))/k
+    """
+    e = math.exp(-kmer * (1-identity))
+
+    return e / (2-e)
+
+
+def cluster_sequences(seqs, identity=0.9, kmer=5, size=64, coverage=0.8):
+    """
+    greedy clustering of the sequences, longest first, a sequence joins the
+    first representative of the identity it covers, otherwise it represents
+    a new cluster, return the representative of each sequence
+    """
+    cutoff = min_jaccard(identity, kmer)
+    order = sorted(range(len(seqs)), key=lambda i: -len(seqs[i]))
+    exact = {}
+    sketchs = {}
+    index = {}
+    r = [0] * len(seqs)
+
+    for i in order:
+        seq = seqs[i]
+        if seq in exact:
+            r[i] = exact[seq]
+            continue
+
+        sketch = kmer_sketch(seq, kmer, size)
+        hits = Counter(chain.from_iterable(index[h] for h in sketch if h in index))
+
+        rep = i
+        # the representatives sharing most hashes first, the estimate of a
+        # representative is at most the hashes it shares over the sketch
+        least = cutoff * len(sketch)
+        for j in sorted([j for j, n in hits.items() if n >= least], key=lambda j: (-hits[j], j)):
+            if len(seq) < len(seqs[j]) * coverage:
                 continue
-            seqids.add(seqid)
-            seqid = "%s#%s" % (seqid.replace("/","|"), describe)
-            print(">%s\n%s" % (seqid, seq))
+            if sketch_jaccard(sketch, sketchs[j], size) >= cutoff:
+                rep = j
+                break
+
+        r[i] = rep
+        exact[seq] = rep
+        if rep == i:
+            sketchs[i] = sketch
+            for h in sketch:
+                index.setdefault(h, []).append(i)
+
+    return r
+
+
+def deal_with_pfam(files, describe="SusC", identity=0, kmer=5, size=64, coverage=0.8, members="",
+                   output="", jobs=1):
+
+    seqids = set()
+    names = []
+    seqs = []
+    fh = open_output(output)
+
+    for seqid,seq in read_files(files, jobs):
+        if seqid in seqids:
+            continue
+        seqids.add(seqid)
+        seqid = "%s#%s" % (seqid.replace("/","|"), describe)
+        if not identity:
+            fh.write(">%s\n%s\n" % (seqid, seq))
+            continue
+        names.append(seqid)
+        seqs.append(seq)
+
+    if identity:
+        reps = cluster_sequences(seqs, identity, kmer, size, coverage)
+        for i, rep in enumerate(reps):
+            if i == rep:
+                fh.write(">%s\n%s\n" % (names[i], seqs[i]))
+    if output:
+        fh.close()
+
+    if not identity:
+        return 0
+
+    if members:
+        with open(members, "w") as fh:
+            fh.write("#representative\tmember\n")
+            for i, rep in enumerate(reps):
+                fh.write("%s\t%s\n" % (names[rep], names[i]))
+
+    number = len(set(reps))
+    residues = sum(len(seqs[i]) for i in set(reps))
+    total = sum(len(i) for i in seqs)
+    LOG.info("%s sequences (%s aa) to %s representatives (%s aa), the database shrinks by %.1f%%" % (
+        len(seqs), total, number, residues, 100.0 - residues*100.0/max(total, 1)))
 
     return 0
 
@@ -70,6 +218,20 @@ def add_hlep_args(parser):
         help='Input protein sequence file, format(fasta, fa.gz')
     parser.add_argument('-d', '--describe', metavar='STR', type=str, required=True,
         help='Input gene family name')
+    parser.add_argument('-i', '--identity', metavar='FLOAT', type=float, default=0,
+        help='Cluster the sequences of the identity and keep the representatives, e.g. 0.9, default=0(no clustering)')
+    parser.add_argument('-k', '--kmer', metavar='INT', type=int, default=5,
+        help='Length of the k-mers of the sketches, default=5')
+    parser.add_argument('--sketch', metavar='INT', type=int, default=64,
+        help='Number of hashes of the sketch of each sequence, default=64')
+    parser.add_argument('-c', '--coverage', metavar='FLOAT', type=float, default=0.8,
+        help='Minimum length of a member relative to its representative, default=0.8')
+    parser.add_argument('-m', '--members', metavar='FILE', type=str, default='',
+        help='Output the representative of each sequence')
+    parser.add_argument('-o', '--output', metavar='FILE', type=str, default='',
+        help='Output the sequences, compressed if it ends with .gz, default is stdout')
+    parser.add_argument('-j', '--jobs', metavar='INT', type=int, default=1,
+        help='Number of input files read at the same time, default=1')
 
     return parser
 
@@ -87,13 +249,16 @@ name:
     deal_with_pfam: Process protein sequence and add it to pfam database.
 attention:
     deal_with_pfam PF00953_full.txt -d SusC >SusC.fasta
+    deal_with_pfam PF00953_full.txt -d SusC --identity 0.9 --members SusC.members.tsv >SusC.fasta
+    deal_with_pfam PF00953_full.txt.gz PF07715_full.txt.gz -d SusC --jobs 2 -o SusC.pep.fasta.gz
 version: %s
 contact:  %s <%s>\
         ''' % (__version__, ' '.join(__author__), __email__))
 
     args = add_hlep_args(parser).parse_args()
 
-    deal_with_pfam(args.input, args.describe)
+    deal_with_pfam(args.input, args.describe, args.identity, args.kmer,
+                   args.sketch, args.coverage, args.members, args.output, args.jobs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import logging
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+
+def read_tsv(file, sep=None):
+
+    for line in open(file):
+        line = line.strip()
+
+        if not line or line.startswith("#"):
+            continue
+
+        yield line.split(sep)
+
+
+def read_samples(file):
+
+    r = {}
+
+    for line in read_tsv(file, "\t"):
+        r[line[0]] = line[1]
+
+    return r
+
+
+def demux_m6(files, samples, suffix, out_dir, sep="__"):
+    """
+    split the hits of tagged queries (S0001__id) to the m6 file of each sample,
+    the tag is removed from the qseqid
+    """
+    samples = read_samples(samples)
+    outs = {}
+
+    for tag, sample in samples.items():
+        path = os.path.join(out_dir, sample)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        outs[tag] = os.path.join(path, "%s.%s.m6" % (sample, suffix))
+        open(outs[tag], "w").close()
+
+    # the hits of a sample are consecutive, keep one file open at a time
+    tag, out = None, None
+    n = 0
+
+    for file in files:
+        LOG.info("demux %s" % file)
+        for line in open(file):
+            if not line.strip() or line.startswith("#"):
+                continue
+
+            name, line = line.split(sep, 1)
+            if name != tag:
+                if name not in outs:
+                    raise Exception("Tag %r of %s is not in the samples" % (name, file))
+                if out:
+                    out.close()
+                tag, out = name, open(outs[name], "a")
+            out.write(line)
+            n += 1
+
+    if out:
+        out.close()
+    LOG.info("split %s hits to %s samples" % (n, len(outs)))
+
+    return 0
+
+
+def add_hlep_args(parser):
+
+    parser.add_argument("m6", nargs="+", metavar="FILE", type=str,
+        help="Input search results of the packed samples(*.m6).")
+    parser.add_argument("--samples", metavar="FILE", type=str, required=True,
+        help="Input the tag and name of the samples, batch.samples.tsv.")
+    parser.add_argument("--suffix", metavar="STR", type=str, required=True,
+        help="Suffix of the output, {sample}/{sample}.{suffix}.m6")
+    parser.add_argument("--out_dir", metavar="DIR", type=str, default=".",
+        help="Output directory (default: current directory)")
+    parser.add_argument("--sep", metavar="STR", type=str, default="__",
+        help="Separator of the tag and the qseqid, default=__")
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''
+name:
+    demux_m6.py: Split the search results of packed samples back to the samples
+
+attention:
+    demux_m6.py search*/*.CAZy.m6 --samples batch.samples.tsv --suffix CAZy --out_dir samples
+
+version: %s
+contact:  %s <%s>\
+        ''' % (__version__, ' '.join(__author__), __email__))
+
+    args = add_hlep_args(parser).parse_args()
+    demux_m6(args.m6, args.samples, args.suffix, args.out_dir, args.sep)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -8,7 +8,16 @@ import gzip
 import logging
 import argparse
 
-from collections import OrderedDict
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import partial
+from multiprocessing import Pool
+from collections import OrderedDict, Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 LOG = logging.getLogger(__name__)
 
@@ -17,6 +26,11 @@ __author__ = ("Xingguo Zhang",)
 __email__ = "invicoun@foxmail.com"
 __all__ = []
 
+# contigs of at least NUMPY_GENES genes are scanned with numpy, 0 is never,
+# the single-pass scanner is as fast in bench_find_pul.py (--numpy_genes)
+NUMPY_GENES = 0
+FUNCTIONS = ["degradation", "biosynthesis"]
+LABELS = []
 
 
 def read_tsv(file, sep=None):
@@ -32,39 +46,169 @@ def read_tsv(file, sep=None):
         yield line.split(sep)
 
 
-def process_geneid(file):
+def read_gff(file, feature="CDS"):
+    """
+    read the genes of a gff (prokka, bakta) into an interval index, a contig
+    is (starts, ends, strands) sorted by start, a gene id (ID and locus_tag)
+    points to its contig and its position (1-based) in the contig
+    """
+    LOG.info("reading genes from %r" % file)
+    if file.endswith(".gz"):
+        fh = gzip.open(file, "rt")
+    else:
+        fh = open(file)
+
+    genes = OrderedDict()
+    for line in fh:
+        if line.startswith("##FASTA"):
+            break
+        if not line.strip() or line.startswith("#"):
+            continue
+        line = line.rstrip("\n").split("\t")
+        if len(line) < 9 or line[2] != feature:
+            continue
+        ids = []
+        for i in line[8].split(";"):
+            if i.startswith("ID=") or i.startswith("locus_tag="):
+                ids.append(i.split("=", 1)[1])
+        if line[0] not in genes:
+            genes[line[0]] = []
+        genes[line[0]].append((int(line[3]), int(line[4]), line[6], ids))
+    fh.close()
+
+    contigs = OrderedDict()
+    index = {}
+    for seqid, records in genes.items():
+        records.sort(key=lambda x: (x[0], x[1]))
+        contigs[seqid] = (
+            array("l", [i[0] for i in records]),
+            array("l", [i[1] for i in records]),
+            "".join(i[2] if i[2] in "+-" else "." for i in records)
+        )
+        for position, record in enumerate(records, 1):
+            for i in record[3]:
+                index[i] = (seqid, position)
+
+    return contigs, index
+
+
+def hard_breaks(positions, intervals, gap_bp=-1, strand=False):
+    """
+    the indexes of the positions that start a new cluster, the intergenic
+    distance to the previous gene is above gap_bp or the strand changes
+    """
+    starts, ends, strands = intervals
+    r = array("l")
+
+    for i in range(1, len(positions)):
+        prev, cur = positions[i-1], positions[i]
+        if prev == cur:
+            continue
+        if gap_bp >= 0 and starts[cur-1] - ends[prev-1] - 1 > gap_bp:
+            r.append(i)
+        elif strand and strands[cur-1] != strands[prev-1]:
+            r.append(i)
+
+    return r
+
 
+def process_geneid(file, gff=None, gap_bp=-1, strand=False):
+    """
+    read the genes of each contig into arrays sorted by position, the gene
+    family and function of a gene are indexes of the label table. a contig
+    is (positions, gene positions, families, functions, breaks), the positions
+    keep repeated genes for the clustering, the others keep the last of them.
+    the contig and position of a gene come from its id (sample.contig.N), or
+    from the gff, which also breaks the clusters by distance and strand
+    """
     data = OrderedDict()
-    r = {}
+    labels = []
+    index = {}
+    did = None
+    skip = 0
+
+    if gff:
+        intervals, locate = read_gff(gff)
 
     for line in read_tsv(file, "\t"):
-        geneid = line[0]
-        sample, contig, position = geneid.split(".")
-        did = "%s.%s" % (sample, contig)
-        if did not in data:
-            data[did] = []
-        data[did].append(int(position))
+        if gff:
+            if line[0] not in locate:
+                skip += 1
+                continue
+            seqid, position = locate[line[0]]
+        else:
+            seqid, position = line[0].rsplit(".", 1)
+        if did != seqid:
+            did = seqid
+            if did not in data:
+                data[did] = (array("l"), array("I"), array("I"))
+            positions, families, functions = data[did]
         gene = "PUL"
         if line[1] != ".":
             gene = line[1]
-        r[geneid] = [gene, line[-1]]
-
-    return data, r
+        func = line[-1]
+        if gene not in index:
+            index[gene] = len(labels)
+            labels.append(gene)
+        if func not in index:
+            index[func] = len(labels)
+            labels.append(func)
+        positions.append(int(position))
+        families.append(index[gene])
+        functions.append(index[func])
+    if skip:
+        LOG.warning("%s genes of %s are not in %s" % (skip, file, gff))
+
+    for did, (positions, families, functions) in data.items():
+        if array("l", sorted(positions)) != positions:
+            # a stable sort keeps the last of repeated genes last
+            order = sorted(range(len(positions)), key=positions.__getitem__)
+            positions = array("l", [positions[i] for i in order])
+            families = array("I", [families[i] for i in order])
+            functions = array("I", [functions[i] for i in order])
+        genes = positions
+        if len(set(positions)) != len(positions):
+            keep = [i for i in range(len(positions)) if i+1 == len(positions) or positions[i] != positions[i+1]]
+            genes = array("l", [positions[i] for i in keep])
+            families = array("I", [families[i] for i in keep])
+            functions = array("I", [functions[i] for i in keep])
+        breaks = array("l")
+        if gff:
+            breaks = hard_breaks(positions, intervals[did], gap_bp, strand)
+        data[did] = (positions, genes, families, functions, breaks)
+
+    return data, labels
+
+
+def sorted_positions(glist):
+
+    for i in range(1, len(glist)):
+        if glist[i] < glist[i-1]:
+            return sorted(glist)
+
+    return glist
 
 
 def find_gene_family(glist, gaplen=2, minegene=2, gaps=1):
+    """
+    split the sorted gene positions of a contig into clusters in one pass,
+    the genes of a cluster are at most gaplen genes apart and a cluster is
+    closed at every (gaps+1)th gap
+    """
+    if NUMPY_GENES and np is not None and len(glist) >= NUMPY_GENES:
+        return find_gene_family_numpy(glist, gaplen, minegene, gaps)
 
     r = []
     temp = []
     gs = 0
+    end = None
 
-    for i in sorted(glist):
+    for i in sorted_positions(glist):
         if not temp:
             temp.append(i)
-            continue
-        if i <= (max(temp)+1):
+        elif i <= (end+1):
             temp.append(i)
-        elif i <= (max(temp)+gaplen+1):
+        elif i <= (end+gaplen+1):
             gs += 1
             if gs >= (gaps+1):
                 if len(temp) >= minegene:
@@ -78,56 +222,231 @@ def find_gene_family(glist, gaplen=2, minegene=2, gaps=1):
                 r.append(temp)
             gs = 0
             temp = [i]
+        end = i
     if len(temp) >= minegene:
         r.append(temp)
 
     return r
 
 
-def pul_annotation(seqid, start, end, gene_dict):
+def find_gene_family_numpy(glist, gaplen=2, minegene=2, gaps=1):
+    """
+    find_gene_family on a numpy array of the positions, a cluster ends at a
+    gap longer than gaplen or at every (gaps+1)th shorter gap counted from
+    the last long one
+    """
+    positions = np.sort(np.asarray(glist, dtype=np.int64), kind="stable")
+    if positions.size == 0:
+        return [[]] if minegene <= 0 else []
 
-    strus = []
-    funcs = []
+    step = np.diff(positions)
+    far = step > max(gaplen+1, 1)
+    gap = (step > 1) & ~far
+    count = np.cumsum(gap)
+    count -= np.maximum.accumulate(np.where(far, count, 0))
+    ends = np.flatnonzero(far | (gap & (count % max(gaps+1, 1) == 0))) + 1
 
-    for i in range(start, end+1, 1):
-        geneid = "%s.%s" % (seqid, i)
-        if geneid not in gene_dict:
-            strus.append("_")
-            continue
-        stru, func = gene_dict[geneid]
-        strus.append(stru)
-        if func not in ["degradation", "biosynthesis"]:
-            continue
-        funcs.append(func)
-    if funcs:
-        funcs = max(funcs, key=funcs.count)
-    else:
-        funcs = ""
+    bounds = np.concatenate(([0], ends, [positions.size]))
+    keep = np.flatnonzero(np.diff(bounds) >= minegene)
+
+    return [positions[bounds[i]:bounds[i+1]].tolist() for i in keep]
+
+
+def pul_annotation(start, end, contig, labels):
+
+    positions, families, functions = contig[1:4]
+    start_index = bisect_left(positions, start)
+    end_index = bisect_right(positions, end)
+
+    strus = ["_"] * (end-start+1)
+    for i in range(start_index, end_index):
+        strus[positions[i]-start] = labels[families[i]]
+
+    # the most common function, the first one of a tie
+    funcs = ""
+    count = 0
+    for i, n in Counter(functions[start_index:end_index]).items():
+        if n > count and labels[i] in FUNCTIONS:
+            funcs, count = labels[i], n
 
     return "|".join(strus), funcs
 
 
+def scan_contig(contig, gaplen, gaps):
+    """
+    all gene clusters of a contig, the clusters never span a hard break
+    """
+    positions, breaks = contig[0], contig[4]
+    if not breaks:
+        return find_gene_family(positions, gaplen, 1, gaps)
+
+    r = []
+    last = 0
+    for i in list(breaks) + [len(positions)]:
+        r += find_gene_family(positions[last:i], gaplen, 1, gaps)
+        last = i
 
-def find_pul(file, gaplen=1, minegene=2, gaps=1, anrate=75):
+    return r
 
-    data, gene_dict = process_geneid(file)
 
-    print("#Seq_id\tPULs\tStart\tEnd\tGene Number\tAnnotation Genes\tAnnotation rate(%)\tPul structure\tFunction")
-    n = 0
-    for seqid in data:
-        for temp in find_gene_family(data[seqid], gaplen, minegene, gaps):
-            start, end = min(temp), max(temp)
-            n += 1
-            stru, func = pul_annotation(seqid, start, end, gene_dict)
+def call_pul(contig, labels, settings):
+    """
+    the PULs of a contig for each setting (gaplen, minegene, gaps, anrate),
+    return the number of gene clusters and the PULs with the index of their
+    cluster, the settings share the clusters of the same gaplen and gaps
+    """
+    scans = {}
+    r = []
+
+    for gaplen, minegene, gaps, anrate in settings:
+        if (gaplen, gaps) not in scans:
+            # minegene only drops the short clusters, annotate a cluster once
+            scans[(gaplen, gaps)] = [[temp, None] for temp in
+                                     scan_contig(contig, gaplen, gaps)]
+        clusters = [i for i in scans[(gaplen, gaps)] if len(i[0]) >= minegene]
+        puls = []
+
+        for n, cluster in enumerate(clusters, 1):
+            temp = cluster[0]
+            start, end = temp[0], temp[-1]
             gene_anrate = len(temp)*100.0/(end-start+1)
             if gene_anrate <= anrate:
                 continue
+            if cluster[1] is None:
+                cluster[1] = pul_annotation(start, end, contig, labels)
+            stru, func = cluster[1]
             if ("GH" not in stru) and ("CE" not in stru) and ("Sus" not in stru):
                 continue
-            print("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\t{8}".format(seqid, n, start, end,
+            puls.append((n, "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}".format(start, end,
                 end-start+1, len(temp), gene_anrate, stru, func
                 )
-            )
+            ))
+        r.append((len(clusters), puls))
+
+    return r
+
+
+def _init_worker(labels, numpy_genes=0):
+
+    global LABELS, NUMPY_GENES
+    LABELS = labels
+    NUMPY_GENES = numpy_genes
+
+
+def call_contigs(contigs, settings):
+
+    return [(seqid, call_pul(contig, LABELS, settings)) for seqid, contig in contigs]
+
+
+def partition_contigs(data, size=100000):
+    """
+    group the contigs in order, about size genes per group
+    """
+    r = []
+    genes = 0
+
+    for seqid, contig in data.items():
+        r.append((seqid, contig))
+        genes += len(contig[0])
+        if genes >= size:
+            yield r
+            r = []
+            genes = 0
+    if r:
+        yield r
+
+
+def parse_values(string, type=int):
+    """
+    values of a parameter, separated by commas, start:end[:step] is a range
+    with the end included, e.g. 2,4 or 2:6 or 50:80:10
+    """
+    r = []
+
+    for i in string.split(","):
+        i = i.strip()
+        if not i:
+            continue
+        if ":" not in i:
+            r.append(type(i))
+            continue
+        i = [type(j) for j in i.split(":")]
+        if len(i) == 2:
+            i.append(type(1))
+        start, end, step = i[:3]
+        if step <= 0 or len(i) > 3:
+            raise Exception("Invalid range %r" % string)
+        while start <= end + step*1e-9:
+            r.append(start)
+            start += step
+    if not r:
+        raise Exception("No value in %r" % string)
+
+    return r
+
+
+def setting_tag(setting):
+
+    return "gl%s_mg%s_g%s_ar%g" % setting
+
+
+def find_pul(file, gaplen=1, minegene=2, gaps=1, anrate=75, jobs=1, prefix="find_pul",
+             gff=None, gap_bp=-1, strand=False, numpy_genes=0):
+    """
+    gaplen, minegene, gaps and anrate may be lists, the grid of them is called
+    in one pass, a setting is written to {prefix}.{tag}.pul.xls and the PUL
+    counts of the settings to stdout
+    """
+    values = [i if isinstance(i, (list, tuple)) else [i]
+              for i in [gaplen, minegene, gaps, anrate]]
+    settings = [(a, b, c, d) for a in values[0] for b in values[1]
+                for c in values[2] for d in values[3]]
+    if numpy_genes and np is None:
+        raise Exception("numpy is required by --numpy_genes")
+    data, labels = process_geneid(file, gff, gap_bp, strand)
+
+    header = "#Seq_id\tPULs\tStart\tEnd\tGene Number\tAnnotation Genes\tAnnotation rate(%)\tPul structure\tFunction"
+    if len(settings) == 1:
+        outs = [sys.stdout]
+    else:
+        LOG.info("call the PULs of %s settings" % len(settings))
+        outs = [open("%s.%s.pul.xls" % (prefix, setting_tag(i)), "w") for i in settings]
+    for out in outs:
+        out.write(header + "\n")
+    func = partial(call_contigs, settings=settings)
+
+    if jobs > 1 and len(data) > 1:
+        pool = Pool(jobs, initializer=_init_worker, initargs=(labels, numpy_genes))
+        results = pool.imap(func, partition_contigs(data))
+    else:
+        pool = None
+        _init_worker(labels, numpy_genes)
+        results = map(func, partition_contigs(data))
+
+    # the PULs are numbered by the clusters of all contigs before them
+    ns = [0] * len(settings)
+    counts = [[0, 0, 0] for i in settings]
+    for contigs in results:
+        for seqid, calls in contigs:
+            for i, (clusters, puls) in enumerate(calls):
+                for j, pul in puls:
+                    outs[i].write("%s\t%s\t%s\n" % (seqid, ns[i]+j, pul))
+                ns[i] += clusters
+                counts[i][0] += clusters
+                counts[i][1] += len(puls)
+                counts[i][2] += sum(int(pul.split("\t", 4)[3]) for j, pul in puls)
+
+    if pool:
+        pool.close()
+        pool.join()
+    if len(settings) == 1:
+        return 0
+
+    print("#Setting\tGaplen\tMinegene\tGaps\tAnrate\tClusters\tPULs\tPUL genes\tOutput")
+    for setting, out, count in zip(settings, outs, counts):
+        out.close()
+        print("%s\t%s\t%s\t%s\t%g\t%s\t%s\t%s\t%s" % ((setting_tag(setting),) + setting +
+              tuple(count) + (out.name,)))
 
     return 0
 
@@ -136,14 +455,26 @@ def add_hlep_args(parser):
 
     parser.add_argument('input', metavar='FILE', type=str,
         help='Input pul annotation result file(pul.tsv).')
-    parser.add_argument('-gl', '--gaplen', metavar='INT', type=int, default=4,
-        help="Maximum allowable gap size, default=4")
-    parser.add_argument("-mg", '--minegene', metavar='INT', type=int, default=2,
-        help="Minimum number of genes allowed, default=2")
-    parser.add_argument('-g', '--gaps', metavar='INT', type=int, default=4,
-        help="Minimum number of gaps allowed, default=4")
-    parser.add_argument('-ar', '--anrate', metavar='FLOAT', type=float, default=60.0,
-        help="Minimum genome annotation rate to be met, default=60.0")
+    parser.add_argument('-gl', '--gaplen', metavar='INT', type=str, default="4",
+        help="Maximum allowable gap size, a list (2,4) or range (2:6) for a sweep, default=4")
+    parser.add_argument("-mg", '--minegene', metavar='INT', type=str, default="2",
+        help="Minimum number of genes allowed, a list or range for a sweep, default=2")
+    parser.add_argument('-g', '--gaps', metavar='INT', type=str, default="4",
+        help="Minimum number of gaps allowed, a list or range for a sweep, default=4")
+    parser.add_argument('-ar', '--anrate', metavar='FLOAT', type=str, default="60.0",
+        help="Minimum genome annotation rate to be met, a list or range (50:80:10) for a sweep, default=60.0")
+    parser.add_argument('-j', '--jobs', metavar='INT', type=int, default=1,
+        help="Number of processes calling the PULs of the contigs, default=1")
+    parser.add_argument('-p', '--prefix', metavar='STR', type=str, default="find_pul",
+        help="Prefix of the outputs of a sweep, {prefix}.{setting}.pul.xls, default=find_pul")
+    parser.add_argument('--gff', metavar='FILE', type=str, default=None,
+        help="Input the gff of the genes (prokka, bakta), the genes are located by their ID instead of sample.contig.N")
+    parser.add_argument('--gap_bp', metavar='INT', type=int, default=-1,
+        help="Maximum distance in bp between the genes of a cluster, needs --gff, -1 is no limit, default=-1")
+    parser.add_argument('--strand', action='store_true',
+        help="The genes of a cluster are on the same strand, needs --gff")
+    parser.add_argument('--numpy_genes', metavar='INT', type=int, default=0,
+        help="Scan the contigs of at least INT genes with numpy, 0 is never, default=0")
 
     return parser
 
@@ -164,6 +495,8 @@ name:
 attention:
 
     find_pul.py pul.tsv >stat_pul.tsv
+    find_pul.py pul.tsv --gaplen 2:6 --anrate 50,60,75 --prefix sweep >sweep.stat.tsv
+    find_pul.py pul.tsv --gff prokka.gff --gap_bp 500 --strand >stat_pul.tsv
 optional arguments:
   --gaplen INT             允许插入其他基因的最大数目, default=4
   -mg INT, --minegene INT
@@ -171,6 +504,14 @@ optional arguments:
   --gaps INT            允许最小的开口数目, default=4
   -ar FLOAT, --anrate FLOAT
                         注释上的基因占比, default=60.0
+  -j INT, --jobs INT    并行处理contig的进程数, default=1
+  -p STR, --prefix STR  参数扫描时每组参数的输出前缀, default=find_pul
+  多个参数值(2,4)或范围(2:6, 50:80:10)时同时计算所有参数组合,
+  每组写入 {prefix}.{setting}.pul.xls, 标准输出为各组的PUL统计
+  --gff FILE            基因的gff注释(prokka, bakta), 按基因ID定位基因
+  --gap_bp INT          簇内相邻基因的最大间隔(bp), 需要--gff, default=-1
+  --strand              簇内基因位于同一条链, 需要--gff
+  --numpy_genes INT     基因数不少于INT的contig用numpy扫描, 0为不用, default=0
 
 version: %s
 contact:  %s <%s>\
@@ -178,7 +519,11 @@ contact:  %s <%s>\
 
     args = add_hlep_args(parser).parse_args()
 
-    find_pul(args.input, args.gaplen, args.minegene, args.gaps, args.anrate)
+    if not args.gff and (args.gap_bp >= 0 or args.strand):
+        raise Exception("--gap_bp and --strand need the coordinates of the genes in --gff")
+    find_pul(args.input, parse_values(args.gaplen), parse_values(args.minegene),
+             parse_values(args.gaps), parse_values(args.anrate, float), args.jobs, args.prefix,
+             args.gff, args.gap_bp, args.strand, args.numpy_genes)
 
 
 if __name__ == "__main__":
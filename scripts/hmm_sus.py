@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import logging
+import tempfile
+import subprocess
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+# the Pfam and TIGRFAMs models of the SUS proteins
+SUS_MODELS = {
+    "PF00953": "SusC",
+    "PF07715": "SusC",
+    "PF13715": "SusC",
+    "TIGR04056": "SusC",
+    "PF07980": "SusD",
+    "PF12741": "SusD",
+    "PF12771": "SusD",
+    "PF14322": "SusD",
+    "PF14292": "SusE",
+    "PF16411": "SusE-F",
+}
+
+
+def read_tsv(file, sep=None):
+
+    for line in open(file):
+        line = line.strip()
+
+        if not line or line.startswith("#"):
+            continue
+
+        yield line.split(sep)
+
+
+def read_families(file):
+
+    r = dict(SUS_MODELS)
+
+    if file:
+        for line in read_tsv(file, "\t"):
+            r[line[0].split(".")[0]] = line[1]
+
+    return r
+
+
+def domtbl2m6(file, families):
+    """
+    the domains of the hmmsearch domtblout as the hits of blastp -outfmt
+    '6 std qlen slen stitle', the query is the protein and the subject is
+    the model, sseqid is model#family for susproc.py. the domtblout is in
+    the order of the models, the hits are sorted as blastp writes them, the
+    hits of a protein together and the best first, the domains of a model
+    together
+    """
+    skip = set()
+    best = {}
+    r = []
+
+    for line in open(file):
+        if line.startswith("#"):
+            continue
+        line = line.split(None, 22)
+        name, accession = line[3], line[4]
+        model = accession.split(".")[0] if accession != "-" else name
+        if model not in families:
+            if model not in skip:
+                LOG.warning("model %s is not of a SUS family, skipped" % model)
+                skip.add(model)
+            continue
+        qstart, qend = int(line[17]), int(line[18])
+        sseqid = "%s#%s" % (model, families[model])
+        score = (float(line[12]), -float(line[13]))
+        best[line[0], sseqid] = min(score, best.get((line[0], sseqid), score))
+        r.append(((line[0], sseqid) + score, "\t".join([
+            line[0], sseqid, "%.1f" % (float(line[21])*100),
+            str(qend-qstart+1), "0", "0", str(qstart), str(qend), line[15], line[16],
+            line[12], line[13], line[2], line[5], name
+        ])))
+
+    r.sort(key=lambda x: (x[0][0], best[x[0][:2]], x[0][1], x[0][2:]))
+
+    for key, line in r:
+        yield line
+
+
+def hmm_sus(file, hmm, out, cpu=1, evalue=1e-05, hmmsearch="hmmsearch", families=""):
+    """
+    search the proteins against the SUS models, write the domains as m6
+    """
+    families = read_families(families)
+    fd, domtbl = tempfile.mkstemp(suffix=".domtbl")
+    os.close(fd)
+
+    try:
+        command = [hmmsearch, "--cpu", str(cpu), "--noali", "-E", str(evalue), "--domE", str(evalue),
+                   "--domtblout", domtbl, "-o", os.devnull, hmm, file]
+        LOG.info(" ".join(command))
+        subprocess.check_call(command)
+        n = 0
+        with open(out, "w") as fh:
+            for line in domtbl2m6(domtbl, families):
+                fh.write(line + "\n")
+                n += 1
+    finally:
+        os.remove(domtbl)
+    LOG.info("%s domains of %s" % (n, file))
+
+    return out
+
+
+def add_hlep_args(parser):
+
+    parser.add_argument("input", metavar="FILE", type=str,
+        help="Input protein sequence(fasta).")
+    parser.add_argument("--hmm", metavar="FILE", type=str, required=True,
+        help="Input the models of the SUS families, SUS.hmm")
+    parser.add_argument("-o", "--out", metavar="FILE", type=str, required=True,
+        help="Output the domains in the blastp format '6 std qlen slen stitle', sus.m6")
+    parser.add_argument("--cpu", metavar="INT", type=int, default=1,
+        help="Number of threads of hmmsearch, default=1")
+    parser.add_argument("-e", "--evalue", metavar="NUM", type=float, default=1e-05,
+        help="Evalue cutoff of the proteins and domains, default=1e-05")
+    parser.add_argument("--hmmsearch", metavar="FILE", type=str, default="hmmsearch",
+        help="Path of hmmsearch, default=hmmsearch")
+    parser.add_argument("--families", metavar="FILE", type=str, default="",
+        help="Input the family of other models (accession, family)")
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''
+name:
+    hmm_sus.py: Search proteins against the Pfam and TIGRFAMs models of the SUS families
+
+attention:
+    hmm_sus.py protein.fasta --hmm SUS.hmm --cpu 4 -o sus.m6
+
+version: %s
+contact:  %s <%s>\
+        ''' % (__version__, ' '.join(__author__), __email__))
+
+    args = add_hlep_args(parser).parse_args()
+    hmm_sus(args.input, args.hmm, args.out, args.cpu, args.evalue, args.hmmsearch, args.families)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -5,11 +5,19 @@ import os
 import re
 import sys
 import gzip
+import zlib
+import heapq
+import shutil
 import logging
 import argparse
+import tempfile
 
+from itertools import groupby
+from operator import itemgetter
 from collections import OrderedDict
 
+from susproc import FamilyCodes, stream_sus as stream_sus_hits
+
 LOG = logging.getLogger(__name__)
 
 __version__ = "1.0.0"
@@ -32,58 +40,84 @@ def read_tsv(file, sep=None):
         yield line.split(sep)
 
 
-def read_sus(file):
-
-    r = {}
-
-    for line in read_tsv(file, "\t"):
-        r[line[0]] = line[-1]
-
-    return r
+def stream_sus(file):
+    """
+    the SUS family of the genes in sus.out or stat_sus.tsv, the genes of a
+    family share one string
+    """
+    LOG.info("reading message from %r" % file)
+    codes = FamilyCodes()
 
+    for qseqid, sseqid, code in stream_sus_hits(file, codes):
+        yield qseqid, codes.families[code]
 
-def read_cazy(file):
 
-    r = {}
+def stream_cazy(file):
 
     for line in read_tsv(file, "\t"):
         type = list(set(line[3].split(";")))
         if ("GH" not in type) and ("CE" not in type):
             continue
         #r[line[0]] = ";".join(type)
-        r[line[0]] = line[2]
+        yield line[0], line[2]
+
 
-    return r
+def stream_pul(file):
+
+    for line in read_tsv(file, "\t"):
+        yield line[0], [line[2], line[4]]
+
+
+def read_sus(file):
+
+    return dict(stream_sus(file))
+
+
+def read_cazy(file):
+
+    return dict(stream_cazy(file))
 
 
 def read_pul(file):
 
-    r = {}
+    return dict(stream_pul(file))
 
-    for line in read_tsv(file, "\t"):
-        r[line[0]] = [line[2], line[4]]
 
-    return r
+def seqid_key(seqid):
+    """
+    ids of sample.contig.N sort by contig and gene position, other ids
+    (prokka, bakta locus tags) sort by name
+    """
+    contig, position = (seqid.rsplit(".", 1) + [""])[:2]
+    if position.isdigit():
+        return contig, int(position)
+
+    return seqid, -1
 
 
 def sorted_seqid(seqids):
 
-    r = {}
+    return sorted(set(seqids), key=seqid_key)
 
-    for i in set(seqids):
-        i = i.split(".")
-        seqid = ".".join(i[0:-1])
-        if seqid not in r:
-            r[seqid] = []
-        r[seqid].append(int(i[-1]))
 
-    ids = []
-    for line in sorted(r.items(), key=lambda x:x[0]):
-        for j in sorted(line[1]):
-            ids.append("%s.%s" % (line[0], j))
+def format_gene(seqid, sus=None, cazy=None, pul=None):
+
+    family = "."
+    if sus is not None:
+        family = sus
+    if cazy is not None:
+        if "." != family:
+            family += ";%s" % cazy
+        else:
+            family = cazy
+
+    pulid = "."
+    des = ""
+    if pul is not None:
+        pulid, des = pul
+
+    return "%s\t%s\t%s\t%s" % (seqid, family.strip(";"), pulid, des)
 
-    return ids
-     
 
 def merge_puldb(susfile, cazyfile, pulfile):
 
@@ -91,24 +125,126 @@ def merge_puldb(susfile, cazyfile, pulfile):
     dcazy = read_cazy(cazyfile)
     dpul = read_pul(pulfile)
 
-    seqids = dsus.keys() + dcazy.keys() + dpul.keys()
-    
+    seqids = list(dsus) + list(dcazy) + list(dpul)
+
     print("#Seqid\tGene family\tPulid\tDegradation/Biosynthesis")
     for i in sorted_seqid(seqids):
-        family = "."
-        if i in dsus:
-            family = dsus[i]
-        if i in dcazy:
-            if "." != family:
-                family += ";%s" % dcazy[i]
-            else:
-                family = dcazy[i]
-
-        pulid = "."
-        des = ""
-        if i in dpul:
-            pulid, des = dpul[i]
-        print("%s\t%s\t%s\t%s" % (i, family.strip(";"), pulid, des))
+        print(format_gene(i, dsus.get(i), dcazy.get(i), dpul.get(i)))
+
+    return 0
+
+
+def sorted_stream(records, index, file):
+    """
+    records of a table sorted by (contig, gene position), the last record
+    of a repeated seqid is kept
+    """
+    last = name = value = None
+
+    for seqid, record in records:
+        key = seqid_key(seqid)
+        if last is not None:
+            if key < last:
+                raise Exception("%s is not sorted by contig and gene position at %s" % (file, seqid))
+            if key != last:
+                yield last, index, name, value
+        last, name, value = key, seqid, record
+
+    if last is not None:
+        yield last, index, name, value
+
+
+def merge_puldb_sorted(susfile, cazyfile, pulfile):
+    """
+    k-way merge of the tables sorted by (contig, gene position), only the
+    current gene of each table is kept in memory
+    """
+    streams = [
+        sorted_stream(stream_sus(susfile), 0, susfile),
+        sorted_stream(stream_cazy(cazyfile), 1, cazyfile),
+        sorted_stream(stream_pul(pulfile), 2, pulfile),
+    ]
+
+    print("#Seqid\tGene family\tPulid\tDegradation/Biosynthesis")
+    for key, records in groupby(heapq.merge(*streams), key=itemgetter(0)):
+        r = [None, None, None]
+        for _, index, seqid, record in records:
+            r[index] = record
+        print(format_gene(seqid, *r))
+
+    return 0
+
+
+def partition_tables(susfile, cazyfile, pulfile, partitions, work_dir):
+    """
+    spill the records of the tables to partitions by the hash of the contig,
+    the genes of a contig are in one partition, in the order of the tables
+    """
+    outs = [open(os.path.join(work_dir, "part%s.tsv" % i), "w") for i in range(partitions)]
+    streams = [
+        stream_sus(susfile),
+        stream_cazy(cazyfile),
+        ((seqid, "\t".join(record)) for seqid, record in stream_pul(pulfile)),
+    ]
+
+    for index, records in enumerate(streams):
+        for seqid, record in records:
+            part = zlib.crc32(seqid_key(seqid)[0].encode()) % partitions
+            outs[part].write("%s\t%s\t%s\n" % (index, seqid, record))
+
+    for out in outs:
+        out.close()
+
+    return [i.name for i in outs]
+
+
+def merge_partition(file, codes):
+    """
+    merge the genes of one partition, return the file of the merged lines
+    sorted by contig and gene position
+    """
+    r = [{}, {}, {}]
+
+    for line in open(file):
+        index, seqid, record = line.rstrip("\n").split("\t", 2)
+        if index == "0":
+            record = codes.families[codes.code(record)]
+        elif index == "2":
+            record = record.split("\t")
+        r[int(index)][seqid] = record
+
+    dsus, dcazy, dpul = r
+    out = "%s.merged" % file
+    with open(out, "w") as fh:
+        for i in sorted_seqid(list(dsus) + list(dcazy) + list(dpul)):
+            fh.write("%s\n" % format_gene(i, dsus.get(i), dcazy.get(i), dpul.get(i)))
+    os.remove(file)
+
+    return out
+
+
+def merge_puldb_partitioned(susfile, cazyfile, pulfile, partitions=16, work_dir=None):
+    """
+    hash partition the genes of the tables by contig and merge one partition
+    at a time, the sorted partitions are merged as streams, only the genes
+    of one partition are kept in memory
+    """
+    work_dir = tempfile.mkdtemp(prefix="merge_puldb.", dir=work_dir)
+    codes = FamilyCodes()
+
+    try:
+        files = partition_tables(susfile, cazyfile, pulfile, partitions, work_dir)
+        files = [merge_partition(i, codes) for i in files]
+        LOG.info("merged %s partitions in %s" % (len(files), work_dir))
+
+        print("#Seqid\tGene family\tPulid\tDegradation/Biosynthesis")
+        fhs = [open(i) for i in files]
+        for line in heapq.merge(*fhs, key=lambda x: seqid_key(x.split("\t", 1)[0])):
+            sys.stdout.write(line)
+        for fh in fhs:
+            fh.close()
+    finally:
+        shutil.rmtree(work_dir)
 
     return 0
 
@@ -120,7 +256,13 @@ def add_hlep_args(parser):
     parser.add_argument('--cazy', metavar='FILE', type=str, required=True,
         help="Input cazy annotation result file(cazy.tsv)")
     parser.add_argument("--sus", metavar='FILE', type=str, required=True,
-        help="Input gene annotation result file(sus.tsv)")
+        help="Input SUS annotation result file(sus.out, or the stat_sus.tsv of susproc.py)")
+    parser.add_argument("--sorted", action="store_true",
+        help="The inputs are sorted by contig and gene position, merge them as streams")
+    parser.add_argument("--partitions", metavar="INT", type=int, default=0,
+        help="Merge unsorted inputs in INT partitions hashed by contig, spilled to --tmp_dir, default=0(in memory)")
+    parser.add_argument("--tmp_dir", metavar="DIR", type=str, default=None,
+        help="Directory of the partitions, default is the system temporary directory")
 
     return parser
 
@@ -141,13 +283,21 @@ name:
 attention:
 
     merge_puldb.py pul.tsv --cazy cazy.tsv --sus sus.tsv >merge_puldb.tsv
+    merge_puldb.py pul.tsv --cazy cazy.tsv --sus sus.out >merge_puldb.tsv
+    merge_puldb.py pul.tsv --cazy cazy.tsv --sus sus.tsv --sorted >merge_puldb.tsv
+    merge_puldb.py pul.tsv --cazy cazy.tsv --sus sus.out --partitions 16 >merge_puldb.tsv
 version: %s
 contact:  %s <%s>\
         ''' % (__version__, ' '.join(__author__), __email__))
 
     args = add_hlep_args(parser).parse_args()
 
-    merge_puldb(args.sus, args.cazy, args.input)
+    if args.sorted:
+        merge_puldb_sorted(args.sus, args.cazy, args.input)
+    elif args.partitions > 0:
+        merge_puldb_partitioned(args.sus, args.cazy, args.input, args.partitions, args.tmp_dir)
+    else:
+        merge_puldb(args.sus, args.cazy, args.input)
 
 
 if __name__ == "__main__":
@@ -5,10 +5,11 @@ import os
 import re
 import sys
 import gzip
-import math
 import logging
 import argparse
 
+import numpy as np
+
 LOG = logging.getLogger(__name__)
 
 __version__ = "1.0.0"
@@ -37,86 +38,68 @@ def read_tsv(file, sep="\t"):
     fh.close()
 
 
-def generate_list(length):
-
-    r = []
-
-    for i in range(length):
-        r.append(0)
-
-    return r
-
-
 def read_stat_cazy(files):
-
+    """
+    the family by sample matrix of the gene counts, a family missing from a
+    sample counts 0
+    """
     samples = []
-    data = {}
-    genes = []
-    n = 0
+    otuids = {}
+    rows = []
+    cols = []
+    counts = []
 
-    for file in files:
-        n += 1
+    for col, file in enumerate(files):
         sample = file.split("/")[-1].split(".")[0]
         samples.append(sample)
-        
-        gene = 0
+
         for line in read_tsv(file):
-            gene += int(line[1])
-            if line[0] not in data:
-                data[line[0]] = generate_list(n-1)
-            data[line[0]].append(int(line[1]))
-        genes.append(gene)
+            rows.append(otuids.setdefault(line[0], len(otuids)))
+            cols.append(col)
+            counts.append(int(line[1]))
 
-    return samples, genes, data
+    data = np.zeros((len(otuids), len(samples)))
+    np.add.at(data, (np.array(rows, dtype=int), np.array(cols, dtype=int)), counts)
 
+    return samples, list(otuids), data
 
-def process_unite(genes, data):
-    
-    r = {}
-    meangene = sum(genes)*1.0/len(genes)
 
-    for i in data:
-        temp = []
-        k = 0
-        for j in data[i]:
-            temp.append(j*1.0*meangene/genes[k])
-            k += 1
-        r[i] = temp
+def process_unite(data):
+    """
+    scale the counts of each sample to the mean number of genes of the samples
+    """
+    genes = data.sum(axis=0)
+    meangene = genes.sum()/len(genes)
+    r = np.zeros_like(data)
 
-    return r
-       
+    np.divide(data*meangene, genes, out=r, where=genes > 0)
 
-def process_zscore(otulist):
+    return r
 
-    total = sum(otulist)
-    meanotu = total*1.0/len(otulist)
-    sd = 0
 
-    for i in otulist:
-        sd += math.pow((i-meanotu), 2)
-    sd = math.sqrt(sd/len(otulist))
+def process_zscore(data):
+    """
+    the z-score of each row, a row of the same values scores 0
+    """
+    sd = data.std(axis=1, keepdims=True)
+    r = np.zeros_like(data)
 
-    r = []
-    for i in otulist:
-        r.append("{:.6f}".format((i-meanotu)/sd))
+    np.divide(data-data.mean(axis=1, keepdims=True), sd, out=r, where=sd > 0)
 
     return r
 
 
 def process_cazy2otu(files, maxrow=20):
 
-    samples, genes, data = read_stat_cazy(files)
-    #print(genes)
-    data = process_unite(genes, data)
-    n = 0
+    samples, otuids, data = read_stat_cazy(files)
+    data = process_unite(data)
+    # the most abundant families in every sample, in the order read on ties
+    order = np.argsort(-data.min(axis=1), kind="stable")[:maxrow]
+    data = process_zscore(data[order])
 
     print("#ID\t%s" % "\t".join(samples))
-    for otuid, line in sorted(data.items(), key=lambda x:min(x[1]), reverse=True):
-        n += 1
-        line = process_zscore(line)
-        print("%s\t%s" % (otuid, "\t".join(line)))
-        if n >= maxrow:
-            break
+    for i, line in zip(order, data):
+        print("%s\t%s" % (otuids[i], "\t".join(map("{:.6f}".format, line.tolist()))))
 
     return 0
 
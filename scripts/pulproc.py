@@ -2,13 +2,16 @@
 # -*- coding: utf-8 -*-
 
 
-
+import os
 import re
 import sys
+import sqlite3
 import argparse
 import logging
 
 import codecs
+from functools import lru_cache
+from collections import OrderedDict, Counter
 
 LOG = logging.getLogger(__name__)
 
@@ -17,6 +20,9 @@ __author__ = ("Xingguo Zhang",)
 __email__ = "invicoun@foxmail.com"
 __all__ = []
 
+INDEX_VERSION = "2"
+CATEGORYS = ["degradation", "biosynthesis"]
+
 
 def read_tsv(file, sep=None, encoding=""):
     
@@ -38,22 +44,125 @@ def read_tsv(file, sep=None, encoding=""):
     ft.close()
 
 
+def classify_types(types):
+    """
+    the category of a PUL, degradation, biosynthesis or "" if unknown
+    """
+    if ("degradation"in types) or ("grada" in types):
+        return "degradation"
+    elif ("biosynthesis"in types) or ("synthes" in types):
+        return "biosynthesis"
+
+    return ""
+
+
 def read_describe(file):
 
     r = {}
 
     for line in read_tsv(file, "\t", "utf-8"):
-        r[line[0]] = [line[1], line[6], line[9], line[11], line[2]]
+        r[line[0]] = [line[1], line[6], line[9], line[11], line[2], classify_types(line[11])]
 
     return r
 
 
-def pulproc(file, describe):
+def source_stat(file):
+
+    stat = os.stat(file)
+
+    return "%s:%s" % (stat.st_size, int(stat.st_mtime))
+
+
+def compile_describe(file, index):
+    """
+    compile the PUL descriptions into a sqlite index, keyed by the PUL id,
+    with the category of each PUL
+    """
+    if os.path.exists(index):
+        os.remove(index)
+    db = sqlite3.connect(index)
+    db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    db.execute("""CREATE TABLE pul (id TEXT PRIMARY KEY, pmid TEXT, substrate TEXT,
+        organism TEXT, types TEXT, notes TEXT, category TEXT) WITHOUT ROWID""")
+    r = read_describe(file)
+    db.executemany("INSERT INTO pul VALUES (?, ?, ?, ?, ?, ?, ?)", ([k] + v for k, v in r.items()))
+    db.executemany("INSERT INTO meta VALUES (?, ?)", [
+        ("version", INDEX_VERSION), ("source", source_stat(file))])
+    db.commit()
+    db.close()
+    LOG.info("compile %s PULs of %s to %s" % (len(r), file, index))
+
+    return index
+
+
+def open_index(file, index):
+    """
+    the ids and the lookup of the PUL descriptions in the sqlite index, None
+    if the index is not of this version or PUL.txt changed after it was
+    compiled. only the ids are read up front, the fields of a PUL on its
+    first hit
+    """
+    db = sqlite3.connect("file:%s?mode=ro" % index, uri=True)
+    meta = dict(db.execute("SELECT key, value FROM meta"))
+    if meta.get("version") != INDEX_VERSION or meta.get("source") != source_stat(file):
+        db.close()
+        return None
+    ids = frozenset(i[0] for i in db.execute("SELECT id FROM pul"))
+
+    @lru_cache(maxsize=None)
+    def fetch(pulid):
+
+        return list(db.execute("SELECT pmid, substrate, organism, types, notes, category FROM pul WHERE id=?",
+                               (pulid,)).fetchone())
 
-    r = read_describe(describe)
+    return ids, fetch
+
+
+def read_describe_index(file, index=""):
+    """
+    the ids and the lookup of the PUL descriptions, from the index if it is
+    up to date
+    """
+    if index and os.path.exists(index):
+        r = open_index(file, index)
+        if r:
+            LOG.info("read the PUL descriptions from %s" % index)
+            return r
+        LOG.warning("%s is not up to date with %s, compile it with --compile" % (index, file))
+    r = read_describe(file)
+
+    return r, r.__getitem__
+
+
+def output_stat(counts, lookup, file):
+    """
+    the hits of each category in total, per substrate and per organism
+    """
+    stats = OrderedDict((i, {}) for i in ["total", "substrate", "organism"])
+
+    for pulid, n in counts.items():
+        pmid, substrate, organism, types, notes, category = lookup(pulid)
+        column = CATEGORYS.index(category) + 1 if category else 3
+        for level, name in [("total", "all"), ("substrate", substrate), ("organism", organism)]:
+            if name not in stats[level]:
+                stats[level][name] = [0, 0, 0, 0]
+            stats[level][name][0] += n
+            stats[level][name][column] += n
+
+    with open(file, "w") as fh:
+        fh.write("#Level\tName\tHits\tDegradation\tBiosynthesis\tUnknown\n")
+        for level, names in stats.items():
+            for name, count in sorted(names.items(), key=lambda x: (-x[1][0], x[0])):
+                fh.write("%s\t%s\t%s\n" % (level, name, "\t".join(map(str, count))))
+
+    return file
+
+
+def pulproc(file, describe, index="", stat=""):
+
+    r, lookup = read_describe_index(describe, index)
+    counts = Counter()
 
-    ds = 0
-    bs = 0
     print("#qseqid\tsseqid\tpulid\tpmid\tDegradation/Biosynthesis\tSubstrate final\tOrganism name\tNotes")
     for line in read_tsv(file, "\t"):
         pulid = line[1].split("_")[0]
@@ -64,31 +173,37 @@ def pulproc(file, describe):
             pass
         else:
             continue
-        pmid, substrate, organism, types, notes = r[pulid]
-        if ("degradation"in types) or ("grada" in types):
-            types = "degradation"
-            ds += 1
-        elif ("biosynthesis"in types) or ("synthes" in types):
-            types = "biosynthesis"
-            bs += 1
-        else:
+        pmid, substrate, organism, types, notes, category = lookup(pulid)
+        counts[pulid] += 1
+        if not category:
             LOG.info("Sequence %s type unknown" % line[0])
         print("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}".format(line[0],
-            line[1], pulid, pmid, types, substrate, organism, notes)
+            line[1], pulid, pmid, category or types, substrate, organism, notes)
         )
+
+    ds = sum(n for i, n in counts.items() if lookup(i)[5] == "degradation")
+    bs = sum(n for i, n in counts.items() if lookup(i)[5] == "biosynthesis")
     LOG.info("Total\tDegradation\tBiosynthesis\n{0:,}\t{1:,}\t{2:,}".format(
               ds+bs, ds, bs)
     )
+    if stat:
+        output_stat(counts, lookup, stat)
 
     return 0
 
 
 def add_hlep_args(parser):
 
-    parser.add_argument("input", metavar='FILE', type=str,
+    parser.add_argument("input", metavar='FILE', type=str, nargs='?',
         help="Input annotation result file(pul.out).")
     parser.add_argument("-d", "--describe", metavar='STR', type=str, required=True,
         help="Input gene description file(PUL.txt).")
+    parser.add_argument("--stat", metavar='FILE', type=str, default="",
+        help="Output the hits of degradation and biosynthesis in total, per substrate and per organism, stat_pul.tsv")
+    parser.add_argument("--index", metavar='FILE', type=str, default="",
+        help="Sqlite index of --describe, used if it is up to date, PUL.txt.sqlite")
+    parser.add_argument("--compile", action="store_true",
+        help="Compile --describe into --index and exit")
 
     return parser
 
@@ -106,14 +221,24 @@ name:
     pulproc.py: Annotate statistical PUL analysis results
 
 attention:
-    pulproc.py  pul.out -d PUL.txt >pul.tsv 2>stat.pul.tsv
+    pulproc.py  pul.out -d PUL.txt --stat stat_pul.tsv >pul.tsv
+    pulproc.py --compile -d PUL.txt --index PUL.txt.sqlite
+    pulproc.py  pul.out -d PUL.txt --index PUL.txt.sqlite --stat stat_pul.tsv >pul.tsv
 
 version: %s
 contact:  %s <%s>\
         ''' % (__version__, ' '.join(__author__), __email__))
 
     args = add_hlep_args(parser).parse_args()
-    pulproc(args.input, args.describe)
+
+    if args.compile:
+        if not args.index:
+            parser.error("--compile needs --index")
+        compile_describe(args.describe, args.index)
+        return
+    if not args.input:
+        parser.error("the input pul.out is required")
+    pulproc(args.input, args.describe, args.index, args.stat)
 
 
 if __name__ == "__main__":
@@ -15,6 +15,8 @@ __author__ = ("Xingguo Zhang",)
 __email__ = "invicoun@foxmail.com"
 __all__ = []
 
+SUS_FAMILIES = ["SusC", "SusD", "SusE", "SusE-F"]
+
 
 def read_tsv(file, sep=None):
 
@@ -27,12 +29,50 @@ def read_tsv(file, sep=None):
         yield line.split(sep)
 
 
+class FamilyCodes(object):
+    """
+    the families of the SUS hits as small integer codes, the four SUS
+    families take the first codes, a family is one interned string
+    """
+
+    def __init__(self, families=SUS_FAMILIES):
+
+        self.families = []
+        self.codes = {}
+        for i in families:
+            self.code(i)
+
+    def code(self, family):
+
+        if family not in self.codes:
+            self.codes[family] = len(self.families)
+            self.families.append(sys.intern(family))
+
+        return self.codes[family]
+
+
+def stream_sus(file, codes=None):
+    """
+    the (qseqid, sseqid, family code) of the hits in sus.out, or in the
+    stat_sus.tsv of suslproc, the family of sus.out is after the # of sseqid
+    """
+    codes = codes or FamilyCodes()
+
+    for line in read_tsv(file, "\t"):
+        if "#" in line[1]:
+            sseqid, family = line[1].split("#", 1)
+        else:
+            sseqid, family = line[1], line[-1]
+        yield line[0], sseqid, codes.code(family)
+
+
 def suslproc(file):
 
+    codes = FamilyCodes()
+
     print("#qseqid\tsseqid\tGene family")
-    for line in read_tsv(file, "\t"):
-        sseqid, family = line[1].split("#", 1)
-        print("%s\t%s\t%s" % (line[0], sseqid, family))
+    for qseqid, sseqid, code in stream_sus(file, codes):
+        print("%s\t%s\t%s" % (qseqid, sseqid, codes.families[code]))
 
     return 0
 
@@ -58,7 +98,7 @@ name:
     suslproc.py: Annotate statistical SUS analysis results
 
 attention:
-    suslproc.py  sus.out >sus.tsv
+    suslproc.py  sus.out >stat_sus.tsv
 
 version: %s
 contact:  %s <%s>\